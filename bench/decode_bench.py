@@ -0,0 +1,117 @@
+"""Micro-benchmark for Zyte response decoding: the old str-based pipeline against the bot's
+current one, for a result payload and for photos of a few sizes, plus how long each variant
+stalls the event loop when photos are decoded concurrently.
+
+    python bench/decode_bench.py --photo-kb 40 300 800
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import timeit
+from base64 import b64decode, b64encode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def envelope(body: bytes) -> bytes:
+    return json.dumps({
+        "url": "https://sw.ministry.et/student-result/1000001",
+        "statusCode": 200,
+        "httpResponseBody": b64encode(body).decode(),
+    }).encode("utf-8")
+
+
+def result_body(courses: int) -> bytes:
+    return json.dumps({
+        "student": {"name": "Bench Student", "age": 17, "school": "Bench Secondary School", "woreda": "Bench",
+                    "gender": "F", "photo": "https://sw.ministry.et/photos/1000001.jpg"},
+        "courses": [{"name": f"Course {i}", "score": str(50 + i), "status": "pass"} for i in range(courses)],
+    }).encode("utf-8")
+
+
+# The pipeline before: response.json() decodes the body to str, then b64decode and a second str decode
+def old_result(raw: bytes) -> dict:
+    data = json.loads(raw.decode("utf-8"))
+    return json.loads(b64decode(data["httpResponseBody"]).decode("utf-8"))
+
+
+def old_photo(raw: bytes) -> bytes:
+    data = json.loads(raw.decode("utf-8"))
+    return b64decode(data["httpResponseBody"])
+
+
+def best_of(func, payload, number: int) -> float:
+    return min(timeit.repeat(lambda: func(payload), number=number, repeat=5)) / number
+
+
+async def loop_stall(decode, payloads: list) -> float:
+    # Longest gap seen by a 1 ms ticker while the payloads are decoded concurrently
+    worst, running = 0.0, True
+
+    async def ticker():
+        nonlocal worst
+        last = time.perf_counter()
+        while running:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            worst = max(worst, now - last - 0.001)
+            last = now
+
+    task = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0.01)
+    await asyncio.gather(*(decode(payload) for payload in payloads))
+    running = False
+    await task
+    return worst
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Zyte response decoding micro-benchmark")
+    parser.add_argument("--courses", type=int, default=12)
+    parser.add_argument("--photo-kb", type=int, nargs="+", default=[40, 300, 800])
+    parser.add_argument("--number", type=int, default=200, help="iterations per timing")
+    parser.add_argument("--concurrent", type=int, default=32, help="photos decoded at once for the stall test")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="decode-bench-"))
+    sys.path.insert(0, ROOT)
+    import bot
+
+    def new_result(raw):
+        return bot.json_loads(bot.a2b_base64(bot.json_loads(raw)["httpResponseBody"]))
+
+    def new_photo(raw):
+        return bot.a2b_base64(bot.json_loads(raw)["httpResponseBody"])
+
+    async def new_photo_async(raw):
+        data = await bot.decode_payload(bot.json_loads, raw)
+        return await bot.decode_payload(bot.a2b_base64, data["httpResponseBody"])
+
+    async def old_photo_async(raw):
+        return old_photo(raw)
+
+    print(f"JSON backend: {bot.json_loads.__module__}, offload threshold {bot.DECODE_OFFLOAD_BYTES // 1024} KB")
+    raw = envelope(result_body(args.courses))
+    assert old_result(raw) == new_result(raw)
+    old, new = best_of(old_result, raw, args.number), best_of(new_result, raw, args.number)
+    print(f"result {len(raw) / 1024:7.1f} KB: old {old * 1e6:8.1f} us  new {new * 1e6:8.1f} us  ({old / new:.2f}x)")
+
+    for size in args.photo_kb:
+        raw = envelope(random.Random(size).randbytes(size * 1024))
+        assert old_photo(raw) == new_photo(raw)
+        number = max(10, args.number * 40 // size)
+        old, new = best_of(old_photo, raw, number), best_of(new_photo, raw, number)
+        payloads = [bytes(raw) for _ in range(args.concurrent)]
+        old_stall = asyncio.run(loop_stall(old_photo_async, payloads))
+        new_stall = asyncio.run(loop_stall(new_photo_async, payloads))
+        print(f"photo  {len(raw) / 1024:7.1f} KB: old {old * 1e6:8.1f} us  new {new * 1e6:8.1f} us  ({old / new:.2f}x)"
+              f"  loop stall x{args.concurrent}: old {old_stall * 1000:6.1f} ms  new {new_stall * 1000:6.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Stand-in for the Telegram Bot API: answers every method the bot uses and counts calls.
+
+Point the bot at it with TELEGRAM_API_URL=http://127.0.0.1:<port>.
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+MESSAGE_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "forwardMessage", "copyMessage"}
+EDIT_METHODS = {"editMessageText", "editMessageCaption", "editMessageReplyMarkup", "editMessageMedia"}
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.calls_per_chat = defaultdict(Counter)
+        self.next_message_id = defaultdict(lambda: 1000)
+        self.webhook = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+
+    def message(self, chat_id: int, params: dict, message_id: int = None) -> dict:
+        if message_id is None:
+            self.next_message_id[chat_id] += 1
+            message_id = self.next_message_id[chat_id]
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"},
+            "from": BOT_USER,
+        }
+        if "photo" in params:
+            message["photo"] = [{
+                "file_id": f"photo-{chat_id}-{message_id}", "file_unique_id": f"u{chat_id}-{message_id}",
+                "width": 320, "height": 400,
+            }]
+            message["caption"] = params.get("caption", "")
+        elif "document" in params:
+            message["document"] = {"file_id": f"doc-{chat_id}-{message_id}", "file_unique_id": f"d{message_id}"}
+        else:
+            message["text"] = params.get("text", "")
+        if "reply_markup" in params:
+            message["reply_markup"] = json.loads(params["reply_markup"])
+        return message
+
+    def result(self, method: str, params: dict):
+        chat_id = int(params["chat_id"]) if str(params.get("chat_id", "")).lstrip("-").isdigit() else 0
+        if method == "getMe":
+            return BOT_USER
+        if method in MESSAGE_METHODS:
+            return self.message(chat_id, params)
+        if method in EDIT_METHODS:
+            if "inline_message_id" in params:
+                return True
+            return self.message(chat_id, params, int(params["message_id"]))
+        if method == "getChatMember":
+            user_id = int(params["user_id"])
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}}
+        if method == "getWebhookInfo":
+            return self.webhook
+        if method == "setWebhook":
+            allowed = params.get("allowed_updates")
+            self.webhook.update({
+                "url": params["url"],
+                "max_connections": int(params.get("max_connections", 40)),
+                "allowed_updates": json.loads(allowed) if isinstance(allowed, str) else allowed,
+            })
+            return True
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = {key: value for key, value in (await request.post()).items() if isinstance(value, str)}
+            if request.content_type.startswith("multipart/"):
+                params.update({key: "<file>" for key in ("photo", "document") if key not in params})
+        self.calls[method] += 1
+        if "chat_id" in params:
+            self.calls_per_chat[str(params["chat_id"])][method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({"ok": True, "result": self.result(method, params)})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=20 * 1024 ** 2)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(FakeTelegram(args.latency).app(), host="127.0.0.1", port=args.port)
@@ -0,0 +1,108 @@
+"""Stand-in for Zyte's /v1/extract endpoint serving fake ministry results and photos.
+
+Run alone with `python bench/fake_zyte.py --port 8081`, or let bench/loadtest.py start it.
+"""
+import argparse
+import asyncio
+import json
+import random
+from base64 import b64encode
+from collections import Counter
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+from aiohttp import web
+
+SUBJECTS = [
+    "Amharic", "English", "Mathematics", "Physics", "Chemistry", "Biology",
+    "Geography", "History", "Civics", "Economics", "ICT", "Physical Education",
+]
+
+
+def scan_photo(side: int, seed: int) -> bytes:
+    # A real JPEG shaped like a ministry scan: large, noisy, with EXIF attached
+    from PIL import Image
+    rng = random.Random(seed)
+    image = Image.frombytes("RGB", (side, side * 5 // 4), rng.randbytes(side * (side * 5 // 4) * 3))
+    image = image.resize((side // 8, side * 5 // 32)).resize((side, side * 5 // 4))
+    exif = Image.Exif()
+    exif[0x010F] = "Bench Scanner"  # Make
+    exif[0x0112] = 1  # Orientation
+    output = BytesIO()
+    image.save(output, "JPEG", quality=95, exif=exif)
+    return output.getvalue()
+
+
+class FakeZyte:
+    def __init__(self, latency: float = 0.2, jitter: float = 0.1, error_rate: float = 0.0,
+                 not_found_rate: float = 0.0, courses: int = 8, photo_bytes: int = 40_000, seed: int = 1,
+                 photo_side: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.not_found_rate = not_found_rate
+        self.courses = courses
+        if photo_side:
+            self.photo = scan_photo(photo_side, seed)
+        else:
+            self.photo = b"\xff\xd8\xff\xe0" + random.Random(seed).randbytes(max(photo_bytes - 4, 0))
+        self.random = random.Random(seed)
+        self.calls = Counter()
+
+    def student(self, url) -> dict:
+        registration = url.path.rstrip("/").rsplit("/", 1)[-1]
+        first_name = parse_qs(url.query).get("first_name", ["student"])[0]
+        scores = random.Random(registration).choices(range(20, 100), k=self.courses)
+        return {
+            "student": {
+                "name": f"{first_name.title()} Load Test",
+                "age": 17,
+                "school": "Bench Secondary School",
+                "woreda": "Bench",
+                "gender": "F",
+                "photo": f"https://{url.hostname}/photos/{registration}.jpg",
+            },
+            "courses": [
+                {"name": SUBJECTS[i % len(SUBJECTS)], "score": str(score), "status": "pass" if score >= 50 else "fail"}
+                for i, score in enumerate(scores)
+            ],
+        }
+
+    async def extract(self, request: web.Request) -> web.Response:
+        target = urlparse((await request.json())["url"])
+        kind = "photo" if "/photos/" in target.path else "data"
+        self.calls[kind] += 1
+        await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        if self.random.random() < self.error_rate:
+            self.calls["errors"] += 1
+            return web.json_response({"title": "Website Ban", "status": 520}, status=520)
+        if kind == "data" and self.random.random() < self.not_found_rate:
+            self.calls["not_found"] += 1
+            return web.json_response({"statusCode": 404, "httpResponseBody": b64encode(b"{}").decode()})
+        body = self.photo if kind == "photo" else json.dumps(self.student(target)).encode("utf-8")
+        return web.json_response({
+            "url": target.geturl(),
+            "statusCode": 200,
+            "httpResponseBody": b64encode(body).decode(),
+        })
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 2)
+        app.router.add_post("/v1/extract", self.extract)
+        return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--not-found-rate", type=float, default=0.0)
+    parser.add_argument("--courses", type=int, default=8)
+    parser.add_argument("--photo-bytes", type=int, default=40_000)
+    parser.add_argument("--photo-side", type=int, default=0, help="serve a real JPEG this wide (needs Pillow)")
+    args = parser.parse_args()
+    server = FakeZyte(args.latency, args.jitter, args.error_rate, args.not_found_rate, args.courses, args.photo_bytes,
+                      photo_side=args.photo_side)
+    web.run_app(server.app(), host="127.0.0.1", port=args.port)
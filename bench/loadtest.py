@@ -0,0 +1,266 @@
+"""Offline load test: drives simulated users through the real conversation flow against
+local stand-ins for Zyte and the Bot API, then writes throughput, latency and upstream
+call counts to a JSON file so runs can be compared.
+
+    python bench/loadtest.py --users 500 --concurrency 100 --zyte-latency 0.3 --output run.json
+    python bench/loadtest.py --users 500 --baseline run.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from aiohttp import web
+
+from fake_telegram import FakeTelegram
+from fake_zyte import FakeZyte
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STEPS = ["start", "language", "region", "registration", "first_name"]
+REGIONS = ["aa", "amhara", "oromia", "sw"]
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(values: list) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        "max_ms": round(max(values, default=0) * 1000, 2),
+    }
+
+
+async def start_server(app: web.Application) -> tuple:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+class SimulatedUser:
+    def __init__(self, bot_module, application, user_id: int, registration: str, region: str):
+        self.bot = bot_module
+        self.application = application
+        self.user = {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load{user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+        self.registration = registration
+        self.region = region
+        self.update_id = user_id * 100
+        self.message_id = 0
+
+    def _update(self, payload: dict):
+        self.update_id += 1
+        return self.bot.Update.de_json({"update_id": self.update_id, **payload}, self.application.bot)
+
+    def message(self, text: str):
+        self.message_id += 1
+        message = {"message_id": self.message_id, "date": int(time.time()), "chat": self.chat, "from": self.user, "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self._update({"message": message})
+
+    def callback(self, data: str):
+        message = {"message_id": 1001, "date": int(time.time()), "chat": self.chat, "text": "menu"}
+        query = {"id": str(self.update_id), "from": self.user, "chat_instance": str(self.user["id"]),
+                 "message": message, "data": data}
+        return self._update({"callback_query": query})
+
+    async def send(self, update) -> None:
+        # Same path as a webhook delivery: the update processor, then the handlers
+        await self.application.update_processor.process_update(update, self.application.process_update(update))
+
+    async def run(self, think_time: float) -> dict:
+        updates = [
+            lambda: self.message("/start"),
+            lambda: self.callback("language_en"),
+            lambda: self.callback(f"region_{self.region}"),
+            lambda: self.message(self.registration),
+            lambda: self.message("abebe"),
+        ]
+        timings = {}
+        for step, build in zip(STEPS, updates):
+            if think_time:
+                await asyncio.sleep(random.uniform(0, think_time))
+            started = time.monotonic()
+            await self.send(build())
+            timings[step] = time.monotonic() - started
+        # Think time is excluded so the flow figure reflects only the bot's own latency
+        timings["flow"] = sum(timings.values())
+        return timings
+
+
+async def run(args) -> dict:
+    zyte = FakeZyte(args.zyte_latency, args.zyte_jitter, args.zyte_error_rate, args.not_found_rate,
+                    args.courses, args.photo_bytes, args.seed, args.photo_side)
+    telegram = FakeTelegram(args.telegram_latency)
+    zyte_runner, zyte_port = await start_server(zyte.app())
+    telegram_runner, telegram_port = await start_server(telegram.app())
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    os.chdir(workdir)
+    os.environ.update({
+        "ZYTE_PROXY_URL": f"http://127.0.0.1:{zyte_port}/v1/extract",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{telegram_port}",
+        "TELEGRAM_BOT_TOKEN": "123456:LOADTEST",
+        # Keep every region on the Zyte stand-in; the direct route would reach the real ministry sites
+        "ROUTE_PINS": ",".join(f"{region}:zyte" for region in REGIONS),
+    })
+    sys.path.insert(0, ROOT)
+    import bot
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.ERROR)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    bot.init_db()
+    application = bot.build_application()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    rng = random.Random(args.seed)
+    students = [str(1000000 + i) for i in range(args.distinct_students or args.users)]
+    users = [
+        SimulatedUser(bot, application, 100000 + i, rng.choice(students), rng.choice(REGIONS))
+        for i in range(args.users)
+    ]
+    slots = asyncio.Semaphore(args.concurrency)
+    results, failures = [], []
+
+    async def drive(user: SimulatedUser) -> None:
+        async with slots:
+            try:
+                results.append(await user.run(args.think_time))
+            except Exception as e:
+                failures.append(f"{type(e).__name__}: {e}")
+
+    started = time.monotonic()
+    await asyncio.gather(*(drive(user) for user in users))
+    elapsed = time.monotonic() - started
+
+    await bot.storage.flush()
+    lookups = bot.metrics.percentiles("bot_lookup_seconds")
+    report = {
+        "started_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "python": platform.python_version(),
+        "config": vars(args),
+        "elapsed_s": round(elapsed, 3),
+        "users_completed": len(results),
+        "users_failed": len(failures),
+        "failures": sorted(set(failures))[:20],
+        "throughput": {
+            "flows_per_s": round(len(results) / elapsed, 2) if elapsed else 0,
+            "updates_per_s": round(len(results) * len(STEPS) / elapsed, 2) if elapsed else 0,
+        },
+        "latency": {
+            name: summarize([timings[name] for timings in results]) for name in STEPS + ["flow"]
+        },
+        "bot_lookup_p50_p95_p99_ms": {
+            ",".join(value for _, value in labels): [round(p * 1000, 2) for p in values]
+            for labels, values in lookups.items()
+        },
+        "upstream": {
+            "zyte_calls": dict(zyte.calls),
+            "zyte_calls_per_flow": round((zyte.calls["data"] + zyte.calls["photo"]) / max(len(results), 1), 3),
+            "coalesced_lookups": bot.coalesced_lookups,
+            "lookup_queue": dict(bot.lookup_queue.stats),
+            "upstream_stats": dict(bot.upstream_stats),
+        },
+        "photos": {
+            **bot.photo_store.stats,
+            "normalize_p50_p95_p99_ms": [
+                round(p * 1000, 2)
+                for p in bot.metrics.percentiles("bot_stage_seconds").get((("stage", "photo_normalize"),), [])
+            ],
+        },
+        "telegram": {
+            "calls": dict(telegram.calls),
+            "calls_per_flow": round(sum(telegram.calls.values()) / max(len(results), 1), 3),
+        },
+    }
+
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await zyte_runner.cleanup()
+    await telegram_runner.cleanup()
+    return report
+
+
+def compare(report: dict, baseline: dict) -> list:
+    lines = []
+    for key in ("flows_per_s", "updates_per_s"):
+        old, new = baseline["throughput"].get(key, 0), report["throughput"][key]
+        lines.append(f"{key:>22}: {old:>10} -> {new:>10}  ({(new - old) / old * 100 if old else 0:+.1f}%)")
+    for step in STEPS + ["flow"]:
+        for stat in ("p50_ms", "p99_ms"):
+            old, new = baseline["latency"].get(step, {}).get(stat, 0), report["latency"][step][stat]
+            lines.append(f"{step + ' ' + stat:>22}: {old:>10} -> {new:>10}  ({(new - old) / old * 100 if old else 0:+.1f}%)")
+    for key in ("zyte_calls_per_flow",):
+        lines.append(f"{key:>22}: {baseline['upstream'].get(key, 0):>10} -> {report['upstream'][key]:>10}")
+    lines.append(f"{'telegram calls/flow':>22}: {baseline['telegram'].get('calls_per_flow', 0):>10} -> "
+                 f"{report['telegram']['calls_per_flow']:>10}")
+    return lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline load test for the results bot")
+    parser.add_argument("--users", type=int, default=200, help="simulated users, each runs the full flow once")
+    parser.add_argument("--concurrency", type=int, default=50, help="users in flight at once")
+    parser.add_argument("--think-time", type=float, default=0.0, help="max random pause between steps (s)")
+    parser.add_argument("--distinct-students", type=int, default=0, help="registration pool size, 0 = one per user")
+    parser.add_argument("--zyte-latency", type=float, default=0.2)
+    parser.add_argument("--zyte-jitter", type=float, default=0.1)
+    parser.add_argument("--zyte-error-rate", type=float, default=0.0)
+    parser.add_argument("--not-found-rate", type=float, default=0.0)
+    parser.add_argument("--courses", type=int, default=8, help="courses per result payload")
+    parser.add_argument("--photo-bytes", type=int, default=40_000, help="photo payload size")
+    parser.add_argument("--photo-side", type=int, default=0,
+                        help="serve a real JPEG scan this wide instead of random bytes (needs Pillow)")
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=f"loadtest-{datetime.now():%Y%m%d-%H%M%S}.json")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logging")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    report = asyncio.run(run(args))
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{report['users_completed']} flows in {report['elapsed_s']}s "
+          f"({report['throughput']['flows_per_s']} flows/s), {report['users_failed']} failed")
+    for step, summary in report["latency"].items():
+        print(f"  {step:>12}: p50 {summary['p50_ms']:>8} ms  p99 {summary['p99_ms']:>8} ms")
+    print(f"  zyte calls: {report['upstream']['zyte_calls']}  telegram calls/flow: {report['telegram']['calls_per_flow']}")
+    photos = report["photos"]
+    if photos["normalized"]:
+        print(f"  photos normalized: {photos['normalized']}, {photos['bytes_in'] / 1024:.1f} KB -> "
+              f"{photos['bytes_out'] / 1024:.1f} KB, p50/p95/p99 {photos['normalize_p50_p95_p99_ms']} ms")
+    if baseline:
+        print("vs baseline:")
+        print("\n".join(compare(report, baseline)))
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,64 @@
 import os
 import re
+import csv
+import gzip
 import json
 import logging
+import multiprocessing
 import asyncio
 import sqlite3
-from io import BytesIO
-from base64 import b64decode
-from cachetools import TTLCache
+import queue
+import random
+import signal
+import socket
+import subprocess
+import sys
+import concurrent.futures
+import contextlib
+import contextvars
+from collections import deque
+import hashlib
+import importlib.util
+import threading
+import time
+import zlib
+from io import BytesIO, StringIO
+from binascii import a2b_base64
+from cachetools import LRUCache, TTLCache
+from copy import deepcopy
 from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape, unescape
+
+BOOT_STARTED = time.monotonic()  # before the telegram and aiohttp imports, which dominate import time
+
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ChatAction, ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
 from telegram.ext import (
     ApplicationBuilder,
+    BasePersistence,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     filters,
     CallbackContext,
     ConversationHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
+    PersistenceInput,
 )
 import aiohttp
+from aiohttp import web
+
+try:  # optional, noticeably faster on large Zyte envelopes
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Pillow is imported on first use; photo normalization is skipped when it is not installed
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
 
 # Set up logging
 logging.basicConfig(
@@ -33,6 +72,8 @@ TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "8014071686:AAGPQzkfEr3it1VxPzBy-2m5htPg
 ZYTE_API_KEY = os.getenv("ZYTE_API_KEY", "10d1991606c540669fc91202a70ba7e0")
 CHANNEL_ID = os.getenv("CHANNEL_ID", "@amharictutorialclass")
 ADMIN_IDS = {723559736}  # Replace with your Telegram user ID(s)
+# Schools allowed to use bulk lookups, in addition to admins (comma-separated user IDs)
+BULK_USER_IDS = {int(user_id) for user_id in os.getenv("BULK_USER_IDS", "").split(",") if user_id.strip()}
 
 # API Base URLs for different regions
 REGION_BASE_URLS = {
@@ -43,138 +84,2131 @@ REGION_BASE_URLS = {
 }
 
 # Zyte Proxy URL
-ZYTE_PROXY_URL = "https://api.zyte.com/v1/extract"
+ZYTE_PROXY_URL = os.getenv("ZYTE_PROXY_URL", "https://api.zyte.com/v1/extract")
+# Bot API server, e.g. a local one or the load-test stand-in; empty uses api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+UPSTREAM_MAX_RESPONSE_BYTES = int(os.getenv("UPSTREAM_MAX_RESPONSE_BYTES", 8 * 1024 * 1024))
+DECODE_OFFLOAD_BYTES = int(os.getenv("DECODE_OFFLOAD_BYTES", 256 * 1024))  # larger payloads decode in a thread
+
+# Upstream control: adaptive per-region concurrency, retries, circuit breaker and hedging
+UPSTREAM_INITIAL_CONCURRENCY = float(os.getenv("UPSTREAM_INITIAL_CONCURRENCY", 16))
+UPSTREAM_MIN_CONCURRENCY = float(os.getenv("UPSTREAM_MIN_CONCURRENCY", 2))
+UPSTREAM_MAX_CONCURRENCY = float(os.getenv("UPSTREAM_MAX_CONCURRENCY", 64))
+UPSTREAM_BACKOFF_RATIO = float(os.getenv("UPSTREAM_BACKOFF_RATIO", 0.7))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", 20))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", 2))
+UPSTREAM_RETRY_BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", 0.5))
+UPSTREAM_RETRY_MAX_DELAY = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", 8))
+UPSTREAM_RETRYABLE_STATUSES = {429, 500, 502, 503, 504, 520, 521}
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", 60))
+UPSTREAM_HEDGE_AFTER = float(os.getenv("UPSTREAM_HEDGE_AFTER", 0))  # seconds, 0 disables hedging
+
+# Fetch routes: straight to the ministry site, or through Zyte; the faster healthy one wins per region
+ROUTE_DEFAULT = os.getenv("ROUTE_DEFAULT", "zyte")
+ROUTE_WINDOW = int(os.getenv("ROUTE_WINDOW", 50))  # recent requests kept per region and route
+ROUTE_MIN_SAMPLES = int(os.getenv("ROUTE_MIN_SAMPLES", 5))
+ROUTE_MIN_SUCCESS = float(os.getenv("ROUTE_MIN_SUCCESS", 0.5))
+ROUTE_PROBE_INTERVAL = float(os.getenv("ROUTE_PROBE_INTERVAL", 60))
+ROUTE_PROBE_TIMEOUT = float(os.getenv("ROUTE_PROBE_TIMEOUT", 5))
+ROUTE_PIN_REFRESH_INTERVAL = int(os.getenv("ROUTE_PIN_REFRESH_INTERVAL", 30))
+# Pins applied at startup, as region:route,...; /route changes them at runtime
+ROUTE_PINS = {
+    pin.split(":")[0].strip(): pin.split(":")[1].strip()
+    for pin in os.getenv("ROUTE_PINS", "").split(",") if pin.count(":") == 1
+}
+
+# Outbound HTTP connection pool
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 100))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", 50))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", 300))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 30))
+HTTP_POOL_REPORT_INTERVAL = int(os.getenv("HTTP_POOL_REPORT_INTERVAL", 0))  # seconds, 0 disables
+
+# Result-release watcher: canary lookups per region, given as region:registration:first_name,...
+RELEASE_CANARIES = {
+    canary.split(":")[0].strip(): (canary.split(":")[1].strip(), canary.split(":")[2].strip().lower())
+    for canary in os.getenv("RELEASE_CANARIES", "").split(",") if canary.count(":") == 2
+}
+RELEASE_WATCH_INTERVAL = int(os.getenv("RELEASE_WATCH_INTERVAL", 300))
+RELEASE_NOTIFY_WORKERS = int(os.getenv("RELEASE_NOTIFY_WORKERS", 4))
+RELEASE_NOTIFY_RATE = float(os.getenv("RELEASE_NOTIFY_RATE", 5))  # subscriber lookups per second
+
+# Broadcast pacing, kept under Telegram's ~30 messages/second global limit
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 16))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", 3))
+# A running broadcast is leased to one process and handed over if the lease lapses
+BROADCAST_LEASE_SECONDS = int(os.getenv("BROADCAST_LEASE_SECONDS", 60))
+BROADCAST_CLAIM_BATCH = int(os.getenv("BROADCAST_CLAIM_BATCH", 200))
+
+# Channel membership cache
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", 100000))
+MEMBERSHIP_CACHE_TTL = int(os.getenv("MEMBERSHIP_CACHE_TTL", 3600))
+MEMBERSHIP_NEGATIVE_TTL = int(os.getenv("MEMBERSHIP_NEGATIVE_TTL", 30))
+MEMBERSHIP_CHECK_TIMEOUT = float(os.getenv("MEMBERSHIP_CHECK_TIMEOUT", 3))
+MEMBERSHIP_FALLBACK = os.getenv("MEMBERSHIP_FALLBACK", "stale")  # stale, allow or deny
+
+# Chat cleanup for "Back to Menu"
+MESSAGE_TRACK_LIMIT = int(os.getenv("MESSAGE_TRACK_LIMIT", 200))
+MESSAGE_DELETE_WINDOW = 48 * 3600 - 300  # Telegram refuses deletes after 48h; keep a safety margin
+DELETE_BATCH_SIZE = 100  # deleteMessages accepts up to 100 ids per call
+DELETE_RATE = float(os.getenv("DELETE_RATE", 20))
+DELETE_CONCURRENCY = int(os.getenv("DELETE_CONCURRENCY", 5))
+
+# Update processing: how many updates run at once, and how many may wait
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 64))
+UPDATE_QUEUE_LIMIT = int(os.getenv("UPDATE_QUEUE_LIMIT", 4096))
+
+# Interactive lookup admission: running cap, waiting-room size and how often queue positions are shown
+LOOKUP_WORKERS = int(os.getenv("LOOKUP_WORKERS", 32))
+LOOKUP_QUEUE_LIMIT = int(os.getenv("LOOKUP_QUEUE_LIMIT", 500))
+LOOKUP_PROGRESS_INTERVAL = float(os.getenv("LOOKUP_PROGRESS_INTERVAL", 3))
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", 1.5))  # min seconds between progress edits
+PHOTO_CAPTION_LIMIT = 1024  # Telegram's caption limit, counted after HTML parsing
+
+# Scaled webhook mode: a dispatcher routes updates by user to WEBHOOK_WORKERS worker processes
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 1))
+WORKER_PORT_BASE = int(os.getenv("WORKER_PORT_BASE", 8100))
+WORKER_INDEX = os.getenv("WORKER_INDEX")  # set by the dispatcher for the processes it spawns
+WORKER_FORWARD_TIMEOUT = float(os.getenv("WORKER_FORWARD_TIMEOUT", 10))
+WORKER_RESTART_MAX_DELAY = float(os.getenv("WORKER_RESTART_MAX_DELAY", 60))
+WORKER_STABLE_SECONDS = float(os.getenv("WORKER_STABLE_SECONDS", 60))  # a run this long resets the backoff
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Webhook registration; updates that queued up while the instance slept are kept unless asked otherwise
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0") == "1"
+
+# Conversation/user_data persistence
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", 30))
+PERSISTENCE_IDLE_TTL = int(os.getenv("PERSISTENCE_IDLE_TTL", 1800))
+PERSISTENCE_EVICT_INTERVAL = int(os.getenv("PERSISTENCE_EVICT_INTERVAL", 300))
 
 # Conversation states
-LANGUAGE, REGION, REGISTRATION, FIRST_NAME, FEEDBACK = range(5)
+LANGUAGE, REGION, REGISTRATION, FIRST_NAME, FEEDBACK, BULK_UPLOAD = range(6)
+
+# PDF result sheets
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", 2))
+PDF_FONT_PATH = os.getenv("PDF_FONT_PATH", "")  # optional TTF with Ethiopic glyphs
+
+# Bulk lookup limits
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", 500))
+BULK_MAX_FILE_BYTES = int(os.getenv("BULK_MAX_FILE_BYTES", 1024 * 1024))
+BULK_WORKERS = int(os.getenv("BULK_WORKERS", 8))
+BULK_PROGRESS_INTERVAL = float(os.getenv("BULK_PROGRESS_INTERVAL", 3))
+
+# In-process metrics, exported in Prometheus text format on /metrics and summarized by /perf
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # optional, required as ?token= when set
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+class Metrics:
+    def __init__(self, buckets: list, sample_size: int = 2000):
+        self.buckets = buckets
+        self.sample_size = sample_size
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "counts": [0] * len(self.buckets), "sum": 0.0, "count": 0,
+                    "samples": deque(maxlen=self.sample_size),
+                }
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+                    break
+            histogram["sum"] += value
+            histogram["count"] += 1
+            histogram["samples"].append(value)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name: str, help_text: str, collect):
+        # collect() returns a number, or a {label_value_tuple: number} dict with label names in help_text
+        self.gauges[name] = collect
+        self.help[name] = help_text
+
+    def percentiles(self, name: str, fractions=(0.5, 0.95, 0.99)) -> dict:
+        with self._lock:
+            snapshot = {key: sorted(h["samples"]) for key, h in self.histograms.items() if key[0] == name}
+        result = {}
+        for (_, labels), samples in snapshot.items():
+            if samples:
+                result[labels] = [samples[min(len(samples) - 1, int(len(samples) * f))] for f in fractions]
+        return result
+
+    @staticmethod
+    def _labels(labels) -> str:
+        parts = [f'{k}="{v}"' for k, v in labels]
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            histograms = {key: (list(h["counts"]), h["sum"], h["count"]) for key, h in self.histograms.items()}
+            counters = dict(self.counters)
+        seen = set()
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for (name, labels), value in sorted(counters.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for name, collect in self.gauges.items():
+            try:
+                value = collect()
+            except Exception as e:
+                logger.error(f"Error collecting metric {name}: {e}")
+                continue
+            lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            if isinstance(value, dict):
+                for labels, label_value in value.items():
+                    lines.append(f"{name}{self._labels(labels)} {label_value}")
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(LATENCY_BUCKETS)
+
+# Await something and record its latency (and failure, if any) under a stage label
+async def timed(stage: str, awaitable):
+    started = time.monotonic()
+    try:
+        return await awaitable
+    except Exception:
+        metrics.inc("bot_stage_errors_total", stage=stage)
+        raise
+    finally:
+        metrics.observe("bot_stage_seconds", time.monotonic() - started, stage=stage)
+
+# Cold-start breakdown: time spent in each stage since the previous mark, logged once serving
+class StartupTimer:
+    def __init__(self, started: float):
+        self.started = started
+        self.last = started
+        self.stages = {}
+
+    def mark(self, stage: str):
+        now = time.monotonic()
+        self.stages[stage] = now - self.last
+        self.last = now
+
+    def summary(self) -> str:
+        parts = ", ".join(f"{stage} {seconds * 1000:.0f} ms" for stage, seconds in self.stages.items())
+        return f"{(self.last - self.started) * 1000:.0f} ms ({parts})"
+
+startup = StartupTimer(BOOT_STARTED)
+
+# Result cache settings
+RESULT_CACHE_DB = os.getenv("RESULT_CACHE_DB", "result_cache.db")
+RESULT_CACHE_MEMORY_SIZE = int(os.getenv("RESULT_CACHE_MEMORY_SIZE", 5000))
+RESULT_CACHE_MEMORY_TTL = int(os.getenv("RESULT_CACHE_MEMORY_TTL", 3600))
+RESULT_CACHE_DISK_TTL = int(os.getenv("RESULT_CACHE_DISK_TTL", 7 * 24 * 3600))
+RESULT_CACHE_DISK_MAX_BYTES = int(os.getenv("RESULT_CACHE_DISK_MAX_BYTES", 200 * 1024 * 1024))
+RESULT_CACHE_NEGATIVE_TTL = int(os.getenv("RESULT_CACHE_NEGATIVE_TTL", 300))
+
+# Marker stored for lookups the ministry reported as not found
+NOT_FOUND = "__not_found__"
+
+class StudentNotFound(Exception):
+    pass
+
+# Raised instead of returning None when the caller must tell a failed lookup from a missing student
+class LookupFailed(Exception):
+    pass
+
+# Two-tier result cache: bounded in-memory LRU/TTL in front of a compressed SQLite table
+class ResultCache:
+    def __init__(self, path, memory_size, memory_ttl, disk_ttl, negative_ttl, disk_max_bytes):
+        self.path = path
+        self.disk_ttl = disk_ttl
+        self.negative_ttl = negative_ttl
+        self.disk_max_bytes = disk_max_bytes
+        self.memory = TTLCache(maxsize=memory_size, ttl=memory_ttl)
+        self.negative = TTLCache(maxsize=memory_size, ttl=negative_ttl)
+        self.hits = {"memory": 0, "disk": 0, "negative": 0}
+        self.misses = 0
+        self._conn = None
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(key) -> str:
+        return "|".join(key)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS result_cache (
+                    key TEXT PRIMARY KEY,
+                    payload BLOB,
+                    size INTEGER,
+                    negative INTEGER DEFAULT 0,
+                    expires_at REAL,
+                    accessed_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_result_cache_accessed ON result_cache (accessed_at)")
+            conn.commit()
+            self._disk_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM result_cache").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def _disk_get(self, key: str):
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT payload, negative, expires_at FROM result_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            payload, negative, expires_at = row
+            now = time.time()
+            if expires_at < now:
+                return None
+            conn.execute("UPDATE result_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+        if negative:
+            return NOT_FOUND
+        return json.loads(zlib.decompress(payload))
+
+    def _disk_set(self, key: str, payload: bytes, negative: bool, ttl: int):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            old = conn.execute("SELECT size FROM result_cache WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO result_cache (key, payload, size, negative, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, payload, len(payload), int(negative), now + ttl, now)
+            )
+            self._disk_bytes += len(payload) - (old[0] if old else 0)
+            if self._disk_bytes > self.disk_max_bytes:
+                self._evict(conn, now)
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM result_cache WHERE expires_at < ?", (now,))
+        self._disk_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM result_cache").fetchone()[0]
+        target = self.disk_max_bytes * 0.9
+        cursor = conn.execute("SELECT key, size FROM result_cache ORDER BY accessed_at")
+        evicted = []
+        for key, size in cursor:
+            if self._disk_bytes <= target:
+                break
+            evicted.append((key,))
+            self._disk_bytes -= size
+        conn.executemany("DELETE FROM result_cache WHERE key = ?", evicted)
+        logger.info(f"Result cache evicted {len(evicted)} entries, {self._disk_bytes} bytes on disk")
+
+    async def get(self, key):
+        cache_key = self.make_key(key)
+        if cache_key in self.memory:
+            self.hits["memory"] += 1
+            return self.memory[cache_key]
+        if cache_key in self.negative:
+            self.hits["negative"] += 1
+            return NOT_FOUND
+        value = await asyncio.to_thread(self._disk_get, cache_key)
+        if value is None:
+            self.misses += 1
+            return None
+        if value == NOT_FOUND:
+            self.hits["negative"] += 1
+            self.negative[cache_key] = True
+        else:
+            self.hits["disk"] += 1
+            self.memory[cache_key] = value
+        return value
+
+    async def set(self, key, value: dict):
+        cache_key = self.make_key(key)
+        self.memory[cache_key] = value
+        self.negative.pop(cache_key, None)
+        payload = zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+        await asyncio.to_thread(self._disk_set, cache_key, payload, False, self.disk_ttl)
 
-# Cache with 1-hour expiration
-student_cache = TTLCache(maxsize=100, ttl=3600)
+    async def set_not_found(self, key):
+        cache_key = self.make_key(key)
+        self.negative[cache_key] = True
+        await asyncio.to_thread(self._disk_set, cache_key, b"", True, self.negative_ttl)
+
+    def _purge(self, key: str = None, negative_only: bool = False) -> int:
+        with self._lock:
+            conn = self._connect()
+            if key is not None:
+                deleted = conn.execute("DELETE FROM result_cache WHERE key = ?", (key,)).rowcount
+            elif negative_only:
+                deleted = conn.execute("DELETE FROM result_cache WHERE negative = 1").rowcount
+            else:
+                deleted = conn.execute("DELETE FROM result_cache").rowcount
+            conn.commit()
+            self._disk_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM result_cache").fetchone()[0]
+        return deleted
+
+    async def purge(self, key=None, negative_only: bool = False) -> int:
+        if key is not None:
+            cache_key = self.make_key(key)
+            self.memory.pop(cache_key, None)
+            self.negative.pop(cache_key, None)
+            return await asyncio.to_thread(self._purge, cache_key)
+        self.negative.clear()
+        if not negative_only:
+            self.memory.clear()
+        return await asyncio.to_thread(self._purge, None, negative_only)
+
+    def _disk_stats(self) -> tuple:
+        with self._lock:
+            conn = self._connect()
+            return conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(negative), 0) FROM result_cache"
+            ).fetchone()
+
+    async def stats(self) -> dict:
+        disk_entries, disk_negative = await asyncio.to_thread(self._disk_stats)
+        lookups = sum(self.hits.values()) + self.misses
+        return {
+            "memory_entries": len(self.memory),
+            "negative_entries": len(self.negative),
+            "disk_entries": disk_entries,
+            "disk_negative": disk_negative,
+            "disk_bytes": self._disk_bytes,
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "hit_ratio": (sum(self.hits.values()) / lookups) if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+student_cache = ResultCache(
+    RESULT_CACHE_DB,
+    memory_size=RESULT_CACHE_MEMORY_SIZE,
+    memory_ttl=RESULT_CACHE_MEMORY_TTL,
+    disk_ttl=RESULT_CACHE_DISK_TTL,
+    negative_ttl=RESULT_CACHE_NEGATIVE_TTL,
+    disk_max_bytes=RESULT_CACHE_DISK_MAX_BYTES,
+)
+
+# Photo store settings
+PHOTO_STORE_DIR = os.getenv("PHOTO_STORE_DIR", "photo_store")
+PHOTO_STORE_MAX_BYTES = int(os.getenv("PHOTO_STORE_MAX_BYTES", 500 * 1024 * 1024))
+
+# Photo normalization: downloads are downscaled and re-encoded before they are cached and uploaded
+PHOTO_NORMALIZE = os.getenv("PHOTO_NORMALIZE", "1") == "1"
+PHOTO_MAX_SIDE = int(os.getenv("PHOTO_MAX_SIDE", 800))
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", 82))
+PHOTO_WORKERS = int(os.getenv("PHOTO_WORKERS", 2))
+
+# Telegram file_id per photo URL, backed by a content-addressed local photo store
+class PhotoStore:
+    def __init__(self, db_path, directory, max_bytes, memory_size=10000):
+        self.db_path = db_path
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.file_ids = LRUCache(maxsize=memory_size)
+        self.stats = {
+            "file_id_hits": 0, "store_hits": 0, "downloads": 0, "expired_file_ids": 0,
+            "normalized": 0, "normalize_failed": 0, "bytes_in": 0, "bytes_out": 0,
+        }
+        self._conn = None
+        self._store_bytes = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS photos (
+                    photo_url TEXT PRIMARY KEY,
+                    file_id TEXT,
+                    digest TEXT,
+                    updated_at REAL
+                )
+            """)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], f"{digest}.jpg")
+
+    def _lookup(self, photo_url: str):
+        with self._lock:
+            return self._connect().execute(
+                "SELECT file_id, digest FROM photos WHERE photo_url = ?", (photo_url,)
+            ).fetchone()
+
+    def _save(self, photo_url: str, file_id: str = None, digest: str = None):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT INTO photos (photo_url, file_id, digest, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(photo_url) DO UPDATE SET "
+                "file_id = COALESCE(excluded.file_id, file_id), "
+                "digest = COALESCE(excluded.digest, digest), "
+                "updated_at = excluded.updated_at",
+                (photo_url, file_id, digest, time.time())
+            )
+            conn.commit()
+
+    def _forget_file_id(self, photo_url: str):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("UPDATE photos SET file_id = NULL WHERE photo_url = ?", (photo_url,))
+            conn.commit()
+
+    async def get_file_id(self, photo_url: str) -> str:
+        file_id = self.file_ids.get(photo_url)
+        if file_id is None:
+            row = await asyncio.to_thread(self._lookup, photo_url)
+            if row and row[0]:
+                file_id = row[0]
+                self.file_ids[photo_url] = file_id
+        if file_id:
+            self.stats["file_id_hits"] += 1
+        return file_id
+
+    async def set_file_id(self, photo_url: str, file_id: str):
+        self.file_ids[photo_url] = file_id
+        await asyncio.to_thread(self._save, photo_url, file_id)
+
+    async def forget_file_id(self, photo_url: str):
+        self.stats["expired_file_ids"] += 1
+        self.file_ids.pop(photo_url, None)
+        await asyncio.to_thread(self._forget_file_id, photo_url)
+
+    def _read(self, photo_url: str):
+        row = self._lookup(photo_url)
+        if not row or not row[1]:
+            return None
+        path = self._path(row[1])
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)  # mark as recently used for LRU eviction
+        return data
+
+    def _write(self, photo_url: str, data: bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            if self._store_bytes is None:
+                self._store_bytes = self._scan()[1]
+            else:
+                self._store_bytes += len(data)
+            if self._store_bytes > self.max_bytes:
+                self._evict()
+        self._save(photo_url, digest=digest)
+
+    def _scan(self):
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return files, total
+
+    def _evict(self):
+        files, total = self._scan()
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for _, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        self._store_bytes = total
+        logger.info(f"Photo store evicted {evicted} files, {total} bytes on disk")
+
+    async def get_bytes(self, photo_url: str) -> bytes:
+        data = await asyncio.to_thread(self._read, photo_url)
+        if data is not None:
+            self.stats["store_hits"] += 1
+        return data
+
+    async def put_bytes(self, photo_url: str, data: bytes):
+        await asyncio.to_thread(self._write, photo_url, data)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+photo_store = PhotoStore(RESULT_CACHE_DB, PHOTO_STORE_DIR, PHOTO_STORE_MAX_BYTES)
 
 # SQLite database for subscribers, feedback, and usage logs
-def init_db():
-    conn = sqlite3.connect("bot_data.db")
-    conn.execute("CREATE TABLE IF NOT EXISTS subscribers (user_id INTEGER PRIMARY KEY)")
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS feedback (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            message TEXT,
-            timestamp TEXT,
-            replied INTEGER DEFAULT 0
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS usage_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            action TEXT,
-            timestamp TEXT
-        )
-    """)
-    conn.close()
-
-def load_subscribers():
-    conn = sqlite3.connect("bot_data.db")
-    cursor = conn.execute("SELECT user_id FROM subscribers")
-    subscribers = {row[0] for row in cursor.fetchall()}
-    conn.close()
-    return subscribers
-
-def add_subscriber(user_id):
-    conn = sqlite3.connect("bot_data.db")
-    conn.execute("INSERT OR IGNORE INTO subscribers (user_id) VALUES (?)", (user_id,))
+DB_PATH = os.getenv("DB_PATH", "bot_data.db")
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", 500))
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", 0.5))
+# How long a writer waits on another process's lock (other workers, /archive compact) before failing
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", 30))
+
+# Retention: rows older than their table's window (days, 0 keeps everything) move to daily gzip
+# JSON-lines archives under ARCHIVE_DIR/<table>/ and are deleted from the live database
+RETENTION_DAYS = {
+    "usage_logs": int(os.getenv("RETENTION_USAGE_DAYS", 30)),
+    "feedback": int(os.getenv("RETENTION_FEEDBACK_DAYS", 180)),
+}
+# Only feedback that has been answered is archived, so /reply keeps working on old items
+RETENTION_FILTERS = {"feedback": "replied = 1"}
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+RETENTION_TIME = os.getenv("RETENTION_TIME", "02:30")  # daily, UTC
+RETENTION_DELETE_BATCH = int(os.getenv("RETENTION_DELETE_BATCH", 500))  # ids per DELETE; SQLite before 3.32 binds at most 999
+
+DB_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS subscribers (user_id INTEGER PRIMARY KEY);
+    CREATE TABLE IF NOT EXISTS feedback (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        message TEXT,
+        timestamp TEXT,
+        replied INTEGER DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS usage_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        action TEXT,
+        timestamp TEXT
+    );
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message TEXT,
+        status TEXT DEFAULT 'running',
+        created_at TEXT,
+        finished_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS persisted_user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT,
+        updated_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS persisted_conversations (
+        name TEXT,
+        key TEXT,
+        state INTEGER,
+        PRIMARY KEY (name, key)
+    );
+    CREATE TABLE IF NOT EXISTS release_watch (
+        region TEXT PRIMARY KEY,
+        fingerprint TEXT,
+        checked_at TEXT,
+        released_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS documents (
+        key TEXT PRIMARY KEY,
+        file_id TEXT,
+        updated_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER,
+        user_id INTEGER,
+        status TEXT DEFAULT 'pending',
+        PRIMARY KEY (broadcast_id, user_id)
+    );
+    CREATE TABLE IF NOT EXISTS route_pins (
+        region TEXT PRIMARY KEY,
+        route TEXT,
+        pinned_by INTEGER,
+        pinned_at TEXT
+    );
+"""
+
+# Columns added after the original schema, applied to existing databases on start
+DB_COLUMNS = [
+    ("usage_logs", "region", "TEXT"),
+    ("usage_logs", "latency_ms", "REAL"),
+    ("subscribers", "region", "TEXT"),
+    ("subscribers", "registration", "TEXT"),
+    ("subscribers", "first_name", "TEXT"),
+    ("subscribers", "subscribed_at", "TEXT"),
+    ("subscribers", "notified_at", "TEXT"),
+    ("broadcasts", "owner", "TEXT"),
+    ("broadcasts", "lease_until", "TEXT"),
+    ("broadcast_recipients", "claimed_by", "TEXT"),
+]
+
+# Latency histogram buckets (upper bounds in ms) used by the rollups
+LATENCY_BUCKETS_MS = [100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+def _latency_bucket_sql(column: str) -> str:
+    return "CASE " + " ".join(
+        f"WHEN {column} <= {bucket} THEN {bucket}" for bucket in LATENCY_BUCKETS_MS
+    ) + f" ELSE {LATENCY_BUCKETS_MS[-1] * 10} END"
+
+# The latency histogram only covers interactive lookups, like the average /stats shows next to it
+LATENCY_ROLLUP_FILTER = "action = 'result_lookup'"
+
+# Indexes and rollups maintained by triggers as rows are written, so /stats never scans usage_logs
+DB_ROLLUP_SCHEMA = f"""
+    CREATE INDEX IF NOT EXISTS idx_usage_logs_timestamp ON usage_logs (timestamp);
+    CREATE INDEX IF NOT EXISTS idx_feedback_replied ON feedback (replied);
+    CREATE TABLE IF NOT EXISTS usage_totals (
+        action TEXT,
+        region TEXT,
+        count INTEGER DEFAULT 0,
+        PRIMARY KEY (action, region)
+    );
+    CREATE TABLE IF NOT EXISTS usage_hourly (
+        hour TEXT,
+        action TEXT,
+        region TEXT,
+        count INTEGER DEFAULT 0,
+        latency_total REAL DEFAULT 0,
+        latency_count INTEGER DEFAULT 0,
+        PRIMARY KEY (hour, action, region)
+    );
+    CREATE TABLE IF NOT EXISTS usage_daily (
+        day TEXT,
+        action TEXT,
+        region TEXT,
+        count INTEGER DEFAULT 0,
+        latency_total REAL DEFAULT 0,
+        latency_count INTEGER DEFAULT 0,
+        PRIMARY KEY (day, action, region)
+    );
+    CREATE TABLE IF NOT EXISTS latency_hourly (
+        hour TEXT,
+        bucket_ms INTEGER,
+        count INTEGER DEFAULT 0,
+        PRIMARY KEY (hour, bucket_ms)
+    );
+    CREATE TABLE IF NOT EXISTS user_activity (
+        user_id INTEGER PRIMARY KEY,
+        last_seen TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_user_activity_last_seen ON user_activity (last_seen);
+
+    CREATE TRIGGER IF NOT EXISTS usage_logs_rollup AFTER INSERT ON usage_logs
+    BEGIN
+        INSERT INTO usage_totals (action, region, count)
+            VALUES (NEW.action, COALESCE(NEW.region, ''), 1)
+            ON CONFLICT (action, region) DO UPDATE SET count = count + 1;
+        INSERT INTO usage_hourly (hour, action, region, count, latency_total, latency_count)
+            VALUES (substr(NEW.timestamp, 1, 13), NEW.action, COALESCE(NEW.region, ''), 1,
+                    COALESCE(NEW.latency_ms, 0), NEW.latency_ms IS NOT NULL)
+            ON CONFLICT (hour, action, region) DO UPDATE SET
+                count = count + 1,
+                latency_total = latency_total + excluded.latency_total,
+                latency_count = latency_count + excluded.latency_count;
+        INSERT INTO usage_daily (day, action, region, count, latency_total, latency_count)
+            VALUES (substr(NEW.timestamp, 1, 10), NEW.action, COALESCE(NEW.region, ''), 1,
+                    COALESCE(NEW.latency_ms, 0), NEW.latency_ms IS NOT NULL)
+            ON CONFLICT (day, action, region) DO UPDATE SET
+                count = count + 1,
+                latency_total = latency_total + excluded.latency_total,
+                latency_count = latency_count + excluded.latency_count;
+        INSERT INTO latency_hourly (hour, bucket_ms, count)
+            SELECT substr(NEW.timestamp, 1, 13), {_latency_bucket_sql("NEW.latency_ms")}, 1
+            WHERE NEW.latency_ms IS NOT NULL AND NEW.{LATENCY_ROLLUP_FILTER}
+            ON CONFLICT (hour, bucket_ms) DO UPDATE SET count = count + 1;
+        INSERT INTO user_activity (user_id, last_seen)
+            VALUES (NEW.user_id, NEW.timestamp)
+            ON CONFLICT (user_id) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS feedback_rollup AFTER INSERT ON feedback
+    BEGIN
+        INSERT INTO usage_totals (action, region, count)
+            VALUES ('feedback', '', 1)
+            ON CONFLICT (action, region) DO UPDATE SET count = count + 1;
+    END;
+"""
+
+# Rebuild rollups from existing rows the first time they are created
+DB_ROLLUP_BACKFILL = """
+    INSERT INTO usage_totals (action, region, count)
+        SELECT action, COALESCE(region, ''), COUNT(*) FROM usage_logs GROUP BY 1, 2;
+    INSERT INTO usage_totals (action, region, count)
+        SELECT 'feedback', '', COUNT(*) FROM feedback;
+    INSERT INTO usage_hourly (hour, action, region, count, latency_total, latency_count)
+        SELECT substr(timestamp, 1, 13), action, COALESCE(region, ''), COUNT(*),
+               COALESCE(SUM(latency_ms), 0), COUNT(latency_ms)
+        FROM usage_logs GROUP BY 1, 2, 3;
+    INSERT INTO usage_daily (day, action, region, count, latency_total, latency_count)
+        SELECT substr(timestamp, 1, 10), action, COALESCE(region, ''), COUNT(*),
+               COALESCE(SUM(latency_ms), 0), COUNT(latency_ms)
+        FROM usage_logs GROUP BY 1, 2, 3;
+    INSERT INTO user_activity (user_id, last_seen)
+        SELECT user_id, MAX(timestamp) FROM usage_logs WHERE user_id IS NOT NULL GROUP BY user_id;
+"""
+
+DB_LATENCY_BACKFILL = f"""
+    DELETE FROM latency_hourly;
+    INSERT INTO latency_hourly (hour, bucket_ms, count)
+        SELECT substr(timestamp, 1, 13), {_latency_bucket_sql("latency_ms")}, COUNT(*)
+        FROM usage_logs WHERE latency_ms IS NOT NULL AND {LATENCY_ROLLUP_FILTER} GROUP BY 1, 2;
+"""
+
+def migrate_db(conn: sqlite3.Connection):
+    conn.executescript(DB_SCHEMA)
+    for table, column, decl in DB_COLUMNS:
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    fresh_rollups = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'usage_totals'"
+    ).fetchone() is None
+    # Older triggers bucketed every action's latency; replace them and rebuild the histogram
+    trigger = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'usage_logs_rollup'"
+    ).fetchone()
+    stale_latency = trigger is not None and f"NEW.{LATENCY_ROLLUP_FILTER}" not in trigger[0]
+    if stale_latency:
+        conn.execute("DROP TRIGGER usage_logs_rollup")
+    conn.executescript(DB_ROLLUP_SCHEMA)
+    if fresh_rollups:
+        conn.executescript(DB_ROLLUP_BACKFILL)
+    if fresh_rollups or stale_latency:
+        conn.executescript(DB_LATENCY_BACKFILL)
     conn.commit()
-    conn.close()
 
-def save_feedback(user_id, message):
-    conn = sqlite3.connect("bot_data.db")
-    conn.execute(
+def _resolve(future: asyncio.Future, result=None, error: Exception = None):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+# One long-lived WAL connection owned by a writer thread; writes are queued and
+# committed in batches, reads run on per-thread connections off the event loop.
+class Storage:
+    def __init__(self, path: str, batch_size: int, flush_interval: float, busy_timeout: float = 5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.busy_timeout = busy_timeout
+        self.batches = 0
+        self.rows_written = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._ready = threading.Event()
+        self._local = threading.local()
+        self._read_conns = []
+        self._read_lock = threading.Lock()
+        self._start_error = None
+
+    def start(self, setup=migrate_db):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._writer, args=(setup,), name="storage-writer", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._start_error is not None:
+            raise self._start_error
+
+    def _writer(self, setup):
+        try:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+            # Only takes effect on a new database, before WAL writes its header; /archive compact converts old ones
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            setup(conn)
+        except Exception as e:
+            self._start_error = e
+            self._ready.set()
+            return
+        self._ready.set()
+
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            batch = []
+            task = None
+            deadline = time.monotonic() + self.flush_interval
+            while item is not None:
+                if callable(item[0]):
+                    # Maintenance runs alone, after the writes queued ahead of it are committed
+                    task = item
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                stopping = True
+            if batch:
+                self._flush(conn, batch)
+            if task:
+                self._run_task(conn, task)
+        conn.close()
+
+    def _run_task(self, conn: sqlite3.Connection, task: tuple):
+        fn, _, future, loop = task
+        started = time.monotonic()
+        result = error = None
+        try:
+            result = fn(conn)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error running queued maintenance {getattr(fn, '__name__', fn)}: {e}")
+            error = e
+        finally:
+            metrics.observe("bot_stage_seconds", time.monotonic() - started, stage="db_maintenance")
+        try:
+            loop.call_soon_threadsafe(_resolve, future, result, error)
+        except RuntimeError as e:
+            logger.warning(f"Could not resolve queued maintenance, its event loop is gone: {e}")
+
+    def _flush(self, conn: sqlite3.Connection, batch: list):
+        started = time.monotonic()
+        try:
+            self._flush_batch(conn, batch)
+        finally:
+            metrics.observe("bot_stage_seconds", time.monotonic() - started, stage="db_flush")
+            metrics.inc("bot_db_rows_written_total", len(batch))
+
+    def _flush_batch(self, conn: sqlite3.Connection, batch: list):
+        results = []
+        try:
+            i = 0
+            while i < len(batch):
+                sql, params, future, loop = batch[i]
+                if future is not None:
+                    cursor = conn.execute(sql, params)
+                    results.append((future, loop, (cursor.lastrowid, cursor.rowcount)))
+                    i += 1
+                    continue
+                # Group consecutive fire-and-forget writes of the same statement
+                j = i
+                while j < len(batch) and batch[j][0] == sql and batch[j][2] is None:
+                    j += 1
+                conn.executemany(sql, [item[1] for item in batch[i:j]])
+                i = j
+            conn.commit()
+            self.batches += 1
+            self.rows_written += len(batch)
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error flushing {len(batch)} queued writes, retrying one by one: {e}")
+            results = []
+            for sql, params, future, loop in batch:
+                try:
+                    cursor = conn.execute(sql, params)
+                    conn.commit()
+                    self.rows_written += 1
+                    if future is not None:
+                        results.append((future, loop, (cursor.lastrowid, cursor.rowcount), None))
+                except Exception as item_error:
+                    conn.rollback()
+                    logger.error(f"Error writing queued statement {sql!r}: {item_error}")
+                    if future is not None:
+                        results.append((future, loop, None, item_error))
+        else:
+            results = [(future, loop, result, None) for future, loop, result in results]
+        # Resolved only once the rows are committed, so a closed loop can't trigger a second write
+        for future, loop, result, error in results:
+            try:
+                loop.call_soon_threadsafe(_resolve, future, result, error)
+            except RuntimeError as e:
+                logger.warning(f"Could not resolve a queued write, its event loop is gone: {e}")
+
+    def write(self, sql: str, params: tuple = ()):
+        self._queue.put((sql, params, None, None))
+
+    async def execute(self, sql: str, params: tuple = ()) -> tuple:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((sql, params, future, loop))
+        return await future
+
+    async def flush(self):
+        await self.execute("SELECT 1")
+
+    # Runs fn(conn) on the writer's connection, in order with the queued writes
+    async def run(self, fn):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((fn, None, future, loop))
+        return await future
+
+    def _read_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._local.conn = conn
+            with self._read_lock:
+                self._read_conns.append(conn)
+        return conn
+
+    def _fetch(self, sql: str, params: tuple, one: bool):
+        started = time.monotonic()
+        try:
+            cursor = self._read_conn().execute(sql, params)
+            return cursor.fetchone() if one else cursor.fetchall()
+        except Exception:
+            metrics.inc("bot_stage_errors_total", stage="db_read")
+            raise
+        finally:
+            metrics.observe("bot_stage_seconds", time.monotonic() - started, stage="db_read")
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await asyncio.to_thread(self._fetch, sql, params, True)
+
+    async def fetchall(self, sql: str, params: tuple = ()):
+        return await asyncio.to_thread(self._fetch, sql, params, False)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        with self._read_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns.clear()
+
+storage = Storage(DB_PATH, DB_BATCH_SIZE, DB_FLUSH_INTERVAL, DB_BUSY_TIMEOUT)
+
+def init_db():
+    storage.start()
+
+async def load_subscribers():
+    rows = await storage.fetchall("SELECT user_id FROM subscribers")
+    return {row[0] for row in rows}
+
+def add_subscriber(user_id, region=None, registration=None, first_name=None):
+    storage.write(
+        "INSERT INTO subscribers (user_id, region, registration, first_name, subscribed_at) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (user_id) DO UPDATE SET region = excluded.region, registration = excluded.registration, "
+        "first_name = excluded.first_name, subscribed_at = excluded.subscribed_at, notified_at = NULL",
+        (user_id, region, registration, first_name, datetime.now().isoformat())
+    )
+
+async def save_feedback(user_id, message):
+    lastrowid, _ = await storage.execute(
         "INSERT INTO feedback (user_id, message, timestamp) VALUES (?, ?, ?)",
         (user_id, message, datetime.now().isoformat())
     )
-    conn.commit()
-    conn.close()
+    return lastrowid
+
+def log_usage(user_id, action, region=None, latency_ms=None):
+    storage.write(
+        "INSERT INTO usage_logs (user_id, action, timestamp, region, latency_ms) VALUES (?, ?, ?, ?, ?)",
+        (user_id, action, datetime.now().isoformat(), region, latency_ms)
+    )
+
+# Persistence for conversation states and user_data. Only users the Application marks as
+# changed are written, each as its own row; user_data is loaded on a user's first update
+# and idle users are evicted from memory after being written out.
+class SQLitePersistence(BasePersistence):
+    def __init__(self, update_interval: float, idle_ttl: int):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.idle_ttl = idle_ttl
+        self._loaded = set()
+        self._last_access = {}
+        self._evicting = set()
+        self._application = None
+        self.stats = {"loaded": 0, "written": 0, "evicted": 0}
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = await storage.fetchall("SELECT key, state FROM persisted_conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        if new_state is None:
+            storage.write(
+                "DELETE FROM persisted_conversations WHERE name = ? AND key = ?", (name, json.dumps(list(key)))
+            )
+        else:
+            storage.write(
+                "INSERT OR REPLACE INTO persisted_conversations (name, key, state) VALUES (?, ?, ?)",
+                (name, json.dumps(list(key)), new_state)
+            )
+
+    @staticmethod
+    def _dump(user_id: int, data: dict) -> str:
+        try:
+            return json.dumps(data)
+        except (TypeError, ValueError):
+            pass
+        # Values that aren't plain JSON are left out rather than silently stringified
+        kept = {}
+        for key, value in data.items():
+            try:
+                json.dumps(value)
+                kept[key] = value
+            except (TypeError, ValueError):
+                logger.error(f"Not persisting user_data[{key!r}] for {user_id}: {type(value).__name__} is not JSON")
+        return json.dumps(kept)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self.stats["written"] += 1
+        storage.write(
+            "INSERT OR REPLACE INTO persisted_user_data (user_id, data, updated_at) VALUES (?, ?, ?)",
+            (user_id, self._dump(user_id, data), datetime.now().isoformat())
+        )
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        self._last_access[user_id] = time.monotonic()
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        row = await storage.fetchone("SELECT data FROM persisted_user_data WHERE user_id = ?", (user_id,))
+        if row:
+            self.stats["loaded"] += 1
+            for key, value in json.loads(row[0]).items():
+                user_data.setdefault(key, value)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._evicting:
+            # Dropped from memory by evict_idle; the stored row stays
+            self._evicting.discard(user_id)
+            if user_id in self._loaded and user_id in self._application.user_data:
+                # Came back before this flush, which skips updates for dropped ids: save them here
+                await self.update_user_data(user_id, deepcopy(self._application.user_data[user_id]))
+            return
+        self._loaded.discard(user_id)
+        self._last_access.pop(user_id, None)
+        storage.write("DELETE FROM persisted_user_data WHERE user_id = ?", (user_id,))
+
+    async def evict_idle(self, application) -> int:
+        self._application = application
+        cutoff = time.monotonic() - self.idle_ttl
+        idle = [user_id for user_id, last_access in self._last_access.items() if last_access < cutoff]
+        if not idle:
+            return 0
+        for user_id in idle:
+            if user_id in application.user_data:
+                await self.update_user_data(user_id, deepcopy(application.user_data[user_id]))
+        # Committed before the data leaves memory, so refresh_user_data never reads a stale row
+        await storage.flush()
+        evicted = 0
+        for user_id in idle:
+            if self._last_access.get(user_id, 0) >= cutoff:
+                continue  # active again while the rows were being written
+            if user_id in application.user_data:
+                self._evicting.add(user_id)
+                application.drop_user_data(user_id)
+            self._loaded.discard(user_id)
+            self._last_access.pop(user_id, None)
+            evicted += 1
+        self.stats["evicted"] += evicted
+        return evicted
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await storage.flush()
+
+persistence = SQLitePersistence(PERSISTENCE_UPDATE_INTERVAL, PERSISTENCE_IDLE_TTL)
+
+async def evict_idle_user_data(context: CallbackContext) -> None:
+    evicted = await persistence.evict_idle(context.application)
+    if evicted:
+        logger.info(f"Evicted user_data for {evicted} idle users")
+
+def latency_percentile(buckets: list, fraction: float):
+    total = sum(count for _, count in buckets)
+    if not total:
+        return None
+    seen = 0
+    buckets = sorted(buckets)
+    for bucket_ms, count in buckets:
+        seen += count
+        if seen >= total * fraction:
+            return bucket_ms
+    return buckets[-1][0]
 
 subscribed_users = set()
 
+# The running slot held by the update the current task is processing, if any
+_update_slot = contextvars.ContextVar("update_slot", default=None)
+
+# Runs updates from different chats concurrently while keeping each chat's updates in order
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int):
+        # The base semaphore bounds queued + running updates; the running cap is applied
+        # only once an update holds its chat's lock, so a busy chat can't hog the slots.
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.concurrency = max_concurrent_updates
+        self.queued = 0
+        self.running = 0
+        self._running_slots = None
+        self._chat_locks = {}
+
+    @staticmethod
+    def chat_key(update: object):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def initialize(self) -> None:
+        self._running_slots = asyncio.BoundedSemaphore(self.concurrency)
+
+    async def shutdown(self) -> None:
+        self._chat_locks.clear()
+
+    async def _run(self, coroutine) -> None:
+        await self._running_slots.acquire()
+        self.queued -= 1
+        self.running += 1
+        slot = {"held": True}
+        token = _update_slot.set(slot)
+        try:
+            await coroutine
+        finally:
+            _update_slot.reset(token)
+            if slot["held"]:
+                self.running -= 1
+                self._running_slots.release()
+
+    @contextlib.asynccontextmanager
+    async def slot_released(self):
+        # For handlers that wait a long time: gives up the running slot but keeps the chat's lock,
+        # so the chat's later updates still wait their turn
+        slot = _update_slot.get()
+        if slot is None or not slot["held"]:
+            yield
+            return
+        slot["held"] = False
+        self.running -= 1
+        self._running_slots.release()
+        try:
+            yield
+        finally:
+            await self._running_slots.acquire()
+            slot["held"] = True
+            self.running += 1
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        if self._running_slots is None:
+            await self.initialize()
+        self.queued += 1
+        key = self.chat_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[key]
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "concurrency": self.concurrency,
+            "active_chats": len(self._chat_locks),
+        }
+
+update_processor = PerChatUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_QUEUE_LIMIT)
+
+# Shared HTTP client, created in post_init and closed on shutdown
+http_session = None
+http_requests_in_flight = 0
+http_requests_total = 0
+
+def create_http_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=HTTP_POOL_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        use_dns_cache=HTTP_DNS_CACHE_TTL > 0,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+    )
+
+def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
+
+async def close_http_session() -> None:
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+def http_pool_stats() -> dict:
+    connector = http_session.connector if http_session is not None and not http_session.closed else None
+    return {
+        "limit": connector.limit if connector else HTTP_POOL_SIZE,
+        "limit_per_host": connector.limit_per_host if connector else HTTP_POOL_PER_HOST,
+        "in_flight": http_requests_in_flight,
+        "total_requests": http_requests_total,
+    }
+
+async def report_http_pool(context: CallbackContext) -> None:
+    stats = http_pool_stats()
+    logger.info(
+        f"HTTP pool: {stats['in_flight']}/{stats['limit']} in use "
+        f"(per host {stats['limit_per_host']}), {stats['total_requests']} requests served"
+    )
+
+# Response decoding: one bounded read, bytes straight into the JSON parser, big payloads off the loop
+# Read a response body into one buffer, refusing anything over limit bytes
+async def read_body(response: aiohttp.ClientResponse, limit: int) -> bytearray:
+    if response.content_length is not None and response.content_length > limit:
+        raise UpstreamError(413, f"response of {response.content_length} bytes exceeds {limit}")
+    body = bytearray()
+    async for chunk in response.content.iter_any():
+        body += chunk
+        if len(body) > limit:
+            raise UpstreamError(413, f"response exceeds {limit} bytes")
+    return body
+
+async def decode_payload(decode, payload):
+    if len(payload) >= DECODE_OFFLOAD_BYTES:
+        return await asyncio.to_thread(decode, payload)
+    return decode(payload)
+
+# Send a request through the Zyte proxy and return the decoded JSON envelope
+async def zyte_extract(url: str) -> dict:
+    global http_requests_in_flight, http_requests_total
+    http_requests_in_flight += 1
+    http_requests_total += 1
+    try:
+        async with get_http_session().post(
+            ZYTE_PROXY_URL,
+            auth=aiohttp.BasicAuth(ZYTE_API_KEY, ""),
+            json={"url": url, "httpResponseBody": True, "geolocation": "ET"},
+        ) as response:
+            response.raise_for_status()
+            body = await read_body(response, UPSTREAM_MAX_RESPONSE_BYTES)
+    finally:
+        http_requests_in_flight -= 1
+    return await decode_payload(json_loads, body)
+
+class UpstreamError(Exception):
+    def __init__(self, status: int, message: str = ""):
+        super().__init__(message or f"upstream returned {status}")
+        self.status = status
+
+class RegionOverloaded(Exception):
+    def __init__(self, region: str):
+        super().__init__(f"region {region} is overloaded")
+        self.region = region
+
+# AIMD concurrency limit: grows by ~1 per window of successes, shrinks multiplicatively on overload
+class AdaptiveLimiter:
+    def __init__(self, initial: float, minimum: float, maximum: float, backoff_ratio: float):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff_ratio = backoff_ratio
+        self.in_flight = 0
+        self._condition = None
+
+    def _cond(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def try_acquire(self) -> bool:
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+
+    async def acquire(self, timeout: float):
+        if self.try_acquire():
+            return
+        condition = self._cond()
+        async with condition:
+            await asyncio.wait_for(condition.wait_for(lambda: self.in_flight < int(self.limit)), timeout)
+            self.in_flight += 1
+
+    async def release(self, overloaded: bool):
+        self.in_flight -= 1
+        if overloaded:
+            self.limit = max(self.minimum, self.limit * self.backoff_ratio)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        condition = self._cond()
+        async with condition:
+            condition.notify_all()
+
+    def abandon(self):
+        # A cancelled request says nothing about upstream health: free the slot, keep the limit
+        self.in_flight -= 1
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        condition = self._cond()
+        async with condition:
+            condition.notify_all()
+
+# Opens after consecutive failures, then lets a single probe through once the reset timeout passes
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        now = time.monotonic()
+        if now - self.opened_at >= self.reset_timeout:
+            # Let one probe through per reset period until one of them succeeds
+            self.state = "half_open"
+            self.opened_at = now
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"Circuit breaker for {self.name} opened after {self.failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+upstream_limiters = {
+    region: AdaptiveLimiter(
+        UPSTREAM_INITIAL_CONCURRENCY, UPSTREAM_MIN_CONCURRENCY, UPSTREAM_MAX_CONCURRENCY, UPSTREAM_BACKOFF_RATIO
+    )
+    for region in REGION_BASE_URLS
+}
+upstream_breakers = {
+    region: CircuitBreaker(region, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT) for region in REGION_BASE_URLS
+}
+upstream_stats = {"retries": 0, "hedged": 0, "hedge_wins": 0}
+
+def region_for_url(url: str) -> str:
+    host = urlparse(url).netloc
+    for region, base_url in REGION_BASE_URLS.items():
+        if urlparse(base_url).netloc == host:
+            return region
+    return None
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (UpstreamError, aiohttp.ClientResponseError)):
+        return error.status in UPSTREAM_RETRYABLE_STATUSES
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+# Routes return {"status": <site status>, "body": <raw bytes>} whichever way the page was fetched
+async def fetch_via_zyte(url: str) -> dict:
+    data = await zyte_extract(url)
+    status = data.get("statusCode")
+    # Same terms as fetch_direct, so a blocked or error-serving route isn't scored as healthy
+    if status not in (200, 404):
+        raise UpstreamError(status)
+    started = time.monotonic()
+    # a2b_base64 reads the ASCII str in place; b64decode would first copy it to bytes
+    body = await decode_payload(a2b_base64, data.get("httpResponseBody", ""))
+    metrics.observe("bot_stage_seconds", time.monotonic() - started, stage="body_decode")
+    return {"status": status, "body": body}
+
+async def fetch_direct(url: str) -> dict:
+    global http_requests_in_flight, http_requests_total
+    http_requests_in_flight += 1
+    http_requests_total += 1
+    try:
+        async with get_http_session().get(url) as response:
+            if response.status not in (200, 404):
+                raise UpstreamError(response.status)
+            body = await read_body(response, UPSTREAM_MAX_RESPONSE_BYTES)
+            return {"status": response.status, "body": bytes(body)}
+    finally:
+        http_requests_in_flight -= 1
+
+FETCH_ROUTES = {"zyte": fetch_via_zyte, "direct": fetch_direct}
+
+class RouteStats:
+    def __init__(self, window: int):
+        self.samples = deque(maxlen=window)  # (succeeded, seconds)
+        self.requests = 0
+        self.failures = 0
+        self.success = None  # moving average, so a recovered route climbs back within a few probes
+
+    def record(self, succeeded: bool, seconds: float) -> None:
+        self.samples.append((succeeded, seconds))
+        self.requests += 1
+        self.failures += not succeeded
+        self.success = float(succeeded) if self.success is None else 0.8 * self.success + 0.2 * succeeded
+
+    def success_rate(self) -> float:
+        return self.success or 0.0
+
+    def latency(self) -> float:
+        timings = sorted(seconds for succeeded, seconds in self.samples if succeeded)
+        return timings[len(timings) // 2] if timings else float("inf")
+
+# Picks a route per region from rolling success and latency, and now and then sends one
+# live request over another route so a recovered or faster route gets noticed
+class RouteSelector:
+    def __init__(self, routes: dict, default: str, window: int, min_samples: int, min_success: float,
+                 probe_interval: float):
+        self.routes = routes
+        self.default = default
+        self.window = window
+        self.min_samples = min_samples
+        self.min_success = min_success
+        self.probe_interval = probe_interval
+        self.stats = {}
+        self.pinned = {}
+        self.last_probe = {}
+        self.probes = 0
+        self.fallbacks = 0
+
+    def route_stats(self, region: str, route: str) -> RouteStats:
+        key = (region, route)
+        if key not in self.stats:
+            self.stats[key] = RouteStats(self.window)
+        return self.stats[key]
+
+    def score(self, region: str, route: str):
+        # Expected seconds per useful answer; None until the route has enough samples
+        stats = self.stats.get((region, route))
+        if stats is None or len(stats.samples) < self.min_samples:
+            return None
+        success = stats.success_rate()
+        if success < self.min_success:
+            return float("inf")
+        return stats.latency() / success
+
+    def best(self, region: str) -> str:
+        if region in self.pinned:
+            return self.pinned[region]
+        scores = {route: self.score(region, route) for route in self.routes}
+        known = {route: score for route, score in scores.items() if score is not None}
+        if scores.get(self.default) is None or not known:
+            return self.default
+        return min(known, key=known.get)
+
+    def choose(self, region: str) -> tuple:
+        best = self.best(region)
+        if region in self.pinned or len(self.routes) < 2:
+            return best, False
+        now = time.monotonic()
+        if now - self.last_probe.get(region, float("-inf")) < self.probe_interval:
+            return best, False
+        self.last_probe[region] = now
+        others = [route for route in self.routes if route != best]
+        self.probes += 1
+        return others[self.probes % len(others)], True
+
+    def fallback(self, region: str, failed: str):
+        if region in self.pinned:
+            return None
+        for route in sorted(self.routes, key=lambda route: route != self.best(region)):
+            score = self.score(region, route)
+            if route != failed and score != float("inf"):
+                return route
+        return None
+
+    def record(self, region: str, route: str, succeeded: bool, seconds: float) -> None:
+        self.route_stats(region, route).record(succeeded, seconds)
+
+route_selector = RouteSelector(
+    FETCH_ROUTES, ROUTE_DEFAULT, ROUTE_WINDOW, ROUTE_MIN_SAMPLES, ROUTE_MIN_SUCCESS, ROUTE_PROBE_INTERVAL
+)
+route_selector.pinned.update({region: route for region, route in ROUTE_PINS.items() if route in FETCH_ROUTES})
+
+# Cheap checks on a 200 body, so a route serving a block or challenge page scores as failing
+def looks_like_json(body) -> bool:
+    return bytes(body[:64]).lstrip()[:1] in (b"{", b"[")
+
+def looks_like_image(body) -> bool:
+    return (body[:3] == b"\xff\xd8\xff" or body[:8] == b"\x89PNG\r\n\x1a\n" or body[:4] == b"GIF8"
+            or (body[:4] == b"RIFF" and body[8:12] == b"WEBP"))
+
+async def fetch_via_route(route: str, url: str, region: str, timeout: float = None, validate=None) -> dict:
+    started = time.monotonic()
+    try:
+        fetch = FETCH_ROUTES[route](url)
+        response = await (asyncio.wait_for(fetch, timeout) if timeout else fetch)
+        if validate and response["status"] == 200 and not validate(response["body"]):
+            raise UpstreamError(502, f"{route} route returned an unexpected payload for {url}")
+    except Exception:
+        route_selector.record(region, route, False, time.monotonic() - started)
+        metrics.inc("bot_route_requests_total", region=region, route=route, outcome="error")
+        raise
+    elapsed = time.monotonic() - started
+    route_selector.record(region, route, True, elapsed)
+    metrics.inc("bot_route_requests_total", region=region, route=route, outcome="ok")
+    metrics.observe("bot_route_seconds", elapsed, region=region, route=route)
+    return response
+
+async def fetch_routed(url: str, region: str, validate=None) -> dict:
+    route, probing = route_selector.choose(region)
+    try:
+        return await fetch_via_route(route, url, region, ROUTE_PROBE_TIMEOUT if probing else None, validate)
+    except Exception as e:
+        fallback = route_selector.fallback(region, route)
+        if fallback is None:
+            raise
+        route_selector.fallbacks += 1
+        logger.info(f"{route} route failed for {region} ({e!r}), retrying over {fallback}")
+        return await fetch_via_route(fallback, url, region, validate=validate)
+
+async def fetch_hedged(url: str, region: str, limiter: AdaptiveLimiter, validate=None) -> dict:
+    if UPSTREAM_HEDGE_AFTER <= 0:
+        return await fetch_routed(url, region, validate)
+    primary = asyncio.ensure_future(fetch_routed(url, region, validate))
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=UPSTREAM_HEDGE_AFTER)
+    except asyncio.CancelledError:
+        primary.cancel()
+        raise
+    if done or not limiter.try_acquire():
+        return await primary
+    upstream_stats["hedged"] += 1
+    hedge = asyncio.ensure_future(fetch_routed(url, region, validate))
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        upstream_stats["hedge_wins"] += 1
+                    return task.result()
+        return primary.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        await limiter.release(overloaded=False)
+
+# Fetch a URL over the region's best route under its limiter, breaker and retry policy
+async def fetch_upstream(url: str, region: str = None, validate=None) -> dict:
+    if region not in upstream_limiters:
+        return await fetch_via_zyte(url)
+    limiter = upstream_limiters[region]
+    breaker = upstream_breakers[region]
+    if not breaker.allow():
+        raise RegionOverloaded(region)
+    for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+        try:
+            await limiter.acquire(UPSTREAM_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise RegionOverloaded(region)
+        try:
+            data = await fetch_hedged(url, region, limiter, validate)
+        except asyncio.CancelledError:
+            limiter.abandon()
+            raise
+        except Exception as e:
+            retryable = is_retryable(e)
+            await limiter.release(overloaded=retryable)
+            if not retryable:
+                # Not a sign of overload, but not a success either: a half-open breaker stays half-open
+                raise
+            if attempt == UPSTREAM_MAX_RETRIES:
+                breaker.record_failure()
+                if breaker.state == "open":
+                    raise RegionOverloaded(region) from e
+                raise
+            upstream_stats["retries"] += 1
+            delay = random.uniform(0, min(UPSTREAM_RETRY_MAX_DELAY, UPSTREAM_RETRY_BASE_DELAY * 2 ** attempt))
+            logger.warning(f"Retrying {region} request in {delay:.2f}s after: {e!r}")
+            await asyncio.sleep(delay)
+            continue
+        await limiter.release(overloaded=False)
+        breaker.record_success()
+        return data
+
+def upstream_status() -> dict:
+    return {
+        region: {
+            "limit": upstream_limiters[region].limit,
+            "in_flight": upstream_limiters[region].in_flight,
+            "breaker": upstream_breakers[region].state,
+            "rejected": upstream_breakers[region].rejected,
+        }
+        for region in REGION_BASE_URLS
+    }
+
+# Identical lookups in flight share one upstream request
+inflight_lookups = {}
+coalesced_lookups = 0
+
+async def fetch_student_data_upstream(region: str, registration: str, first_name: str) -> dict:
+    url = f"{REGION_BASE_URLS[region]}/{registration}?first_name={first_name}&qr="
+    data = await timed("upstream_data", fetch_upstream(url, region, looks_like_json))
+    if data["status"] == 404:
+        raise StudentNotFound(f"{region}/{registration}")
+    started = time.monotonic()
+    result = await decode_payload(json_loads, data["body"])
+    metrics.observe("bot_stage_seconds", time.monotonic() - started, stage="data_decode")
+    if not result or not result.get("student"):
+        raise StudentNotFound(f"{region}/{registration}")
+    return result
+
 # Fetch student data asynchronously
-async def fetch_student_data(region: str, registration: str, first_name: str) -> dict:
+async def fetch_student_data(region: str, registration: str, first_name: str, raise_errors: bool = False) -> dict:
+    global coalesced_lookups
     cache_key = (region, registration, first_name)
-    if cache_key in student_cache:
-        return student_cache[cache_key]
+    cached = await timed("cache_lookup", student_cache.get(cache_key))
+    if cached == NOT_FOUND:
+        return None
+    if cached is not None:
+        return cached
 
-    base_url = REGION_BASE_URLS.get(region)
-    if not base_url:
+    if region not in REGION_BASE_URLS:
         logger.error(f"Invalid region: {region}")
         return None
 
-    url = f"{base_url}/{registration}?first_name={first_name}&qr="
-    async with aiohttp.ClientSession() as session:
+    pending = inflight_lookups.get(cache_key)
+    if pending is not None:
+        coalesced_lookups += 1
+        metrics.inc("bot_coalesced_lookups_total")
         try:
-            async with session.post(
-                ZYTE_PROXY_URL,
-                auth=aiohttp.BasicAuth(ZYTE_API_KEY, ""),
-                json={"url": url, "httpResponseBody": True, "geolocation": "ET"},
-                timeout=aiohttp.ClientTimeout(total=30)
-            ) as response:
-                response.raise_for_status()
-                data = await response.json()
-                http_response_body = b64decode(data["httpResponseBody"])
-                result = json.loads(http_response_body.decode("utf-8"))
-                student_cache[cache_key] = result
-                return result
+            return await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise  # this waiter itself was cancelled
+            # The leader was cancelled, not us: run the lookup again, or join whoever took it over
+            return await fetch_student_data(region, registration, first_name, raise_errors)
+        except StudentNotFound:
+            return None
+        except RegionOverloaded:
+            raise
         except Exception as e:
             logger.error(f"Error fetching student data: {e}")
+            if raise_errors:
+                raise LookupFailed(str(e)) from e
             return None
 
-# Fetch student photo asynchronously
+    future = asyncio.get_running_loop().create_future()
+    inflight_lookups[cache_key] = future
+    try:
+        result = await fetch_student_data_upstream(region, registration, first_name)
+        future.set_result(result)
+        await student_cache.set(cache_key, result)
+        return result
+    except StudentNotFound as e:
+        if not future.done():
+            future.set_exception(e)
+            future.exception()
+        await student_cache.set_not_found(cache_key)
+        return None
+    except RegionOverloaded as e:
+        if not future.done():
+            future.set_exception(e)
+            future.exception()
+        raise
+    except Exception as e:
+        if not future.done():
+            future.set_exception(e)
+            future.exception()  # mark as retrieved when nobody else is waiting
+        logger.error(f"Error fetching student data: {e}")
+        if raise_errors:
+            raise LookupFailed(str(e)) from e
+        return None
+    except BaseException:
+        if not future.done():
+            future.cancel()
+        raise
+    finally:
+        inflight_lookups.pop(cache_key, None)
+
+# Downscale, drop EXIF/ICC metadata and re-encode as baseline JPEG; runs in the photo pool
+def normalize_photo(image_bytes: bytes, max_side: int, quality: int) -> bytes:
+    from PIL import Image, ImageOps
+    with Image.open(BytesIO(image_bytes)) as image:
+        # Lets the JPEG decoder scale down by 1/2..1/8 while decoding large scans
+        image.draft("RGB", (max_side, max_side))
+        # Apply the EXIF orientation before the tag is dropped
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        output = BytesIO()
+        image.save(output, "JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+photo_executor = None
+
+def get_photo_executor() -> concurrent.futures.ThreadPoolExecutor:
+    # Threads are enough: Pillow releases the GIL while decoding, resizing and encoding
+    global photo_executor
+    if photo_executor is None:
+        photo_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=PHOTO_WORKERS, thread_name_prefix="photo"
+        )
+    return photo_executor
+
+def shutdown_photo_executor():
+    global photo_executor
+    if photo_executor is not None:
+        photo_executor.shutdown(wait=False, cancel_futures=True)
+        photo_executor = None
+
+async def normalize_downloaded_photo(image_bytes: bytes) -> bytes:
+    if not PHOTO_NORMALIZE or not PILLOW_AVAILABLE:
+        return image_bytes
+    started = time.monotonic()
+    try:
+        normalized = await asyncio.get_running_loop().run_in_executor(
+            get_photo_executor(), normalize_photo, bytes(image_bytes), PHOTO_MAX_SIDE, PHOTO_JPEG_QUALITY
+        )
+    except Exception as e:
+        # Not an image Pillow understands; pass it through and let Telegram decide
+        photo_store.stats["normalize_failed"] += 1
+        logger.warning(f"Photo normalization failed: {e}")
+        return image_bytes
+    finally:
+        metrics.observe("bot_stage_seconds", time.monotonic() - started, stage="photo_normalize")
+    photo_store.stats["normalized"] += 1
+    photo_store.stats["bytes_in"] += len(image_bytes)
+    photo_store.stats["bytes_out"] += len(normalized)
+    metrics.inc("bot_photo_normalize_bytes_total", len(image_bytes), direction="in")
+    metrics.inc("bot_photo_normalize_bytes_total", len(normalized), direction="out")
+    return normalized
+
+# Fetch student photo asynchronously, preferring the local photo store
 async def fetch_student_photo(photo_url: str) -> BytesIO:
-    async with aiohttp.ClientSession() as session:
+    image_bytes = await photo_store.get_bytes(photo_url)
+    if image_bytes is not None:
+        return BytesIO(image_bytes)
+    try:
+        data = await timed("upstream_photo", fetch_upstream(photo_url, region_for_url(photo_url), looks_like_image))
+        if data["status"] != 200:
+            raise UpstreamError(data["status"])
+        image_bytes = data["body"]
+    except Exception as e:
+        logger.error(f"Error fetching photo via proxy: {e}")
+        return None
+    photo_store.stats["downloads"] += 1
+    image_bytes = await normalize_downloaded_photo(image_bytes)
+    try:
+        await photo_store.put_bytes(photo_url, image_bytes)
+    except OSError as e:
+        logger.error(f"Error storing photo locally: {e}")
+    return BytesIO(image_bytes)
+
+# Telegram's file_id when we have one, otherwise the image bytes
+async def prepare_student_photo(photo_url: str):
+    file_id = await photo_store.get_file_id(photo_url)
+    if file_id:
+        return file_id
+    return await fetch_student_photo(photo_url)
+
+# Send a student photo, reusing Telegram's file_id when we have one
+async def send_student_photo(update: Update, photo_url: str, caption: str, reply_markup=None, photo=None):
+    if photo is None:
+        photo = await prepare_student_photo(photo_url)
+    if isinstance(photo, str):
         try:
-            async with session.post(
-                ZYTE_PROXY_URL,
-                auth=aiohttp.BasicAuth(ZYTE_API_KEY, ""),
-                json={"url": photo_url, "httpResponseBody": True, "geolocation": "ET"},
-                timeout=aiohttp.ClientTimeout(total=30)
-            ) as response:
-                response.raise_for_status()
-                data = await response.json()
-                image_bytes = b64decode(data["httpResponseBody"])
-                return BytesIO(image_bytes)
-        except Exception as e:
-            logger.error(f"Error fetching photo via proxy: {e}")
-            return None
+            return await timed("photo_send", update.message.reply_photo(
+                photo=photo, caption=caption, parse_mode='HTML', reply_markup=reply_markup
+            ))
+        except BadRequest as e:
+            logger.warning(f"Cached file_id for {photo_url} rejected, re-uploading: {e}")
+            await photo_store.forget_file_id(photo_url)
+            photo = await fetch_student_photo(photo_url)
+
+    if not photo:
+        return None
+    photo_message = await timed("photo_upload", update.message.reply_photo(
+        photo=photo, caption=caption, parse_mode='HTML', reply_markup=reply_markup
+    ))
+    if photo_message.photo:
+        await photo_store.set_file_id(photo_url, photo_message.photo[-1].file_id)
+    return photo_message
 
 # Calculate result statistics
-def calculate_result_stats(student_data: dict) -> str:
+def result_stats_values(student_data: dict) -> dict:
     courses = student_data.get("courses", [])
     total_courses = len(courses)
     scores = [float(course.get('score', 0)) for course in courses if 'score' in course and course['score'].isdigit()]
     avg_score = sum(scores) / len(scores) if scores else 0
-    passed = len([course for course in courses if course.get('status', '').lower() == 'pass']) if courses and 'status' in courses[0] else total_courses
+    has_status = bool(courses) and 'status' in courses[0]
+    passed = len([course for course in courses if course.get('status', '').lower() == 'pass']) if has_status else total_courses
+    return {
+        "total_courses": total_courses,
+        "scores": scores,
+        "average_score": avg_score,
+        "has_status": has_status,
+        "passed": passed,
+        "failed": total_courses - passed,
+    }
+
+def calculate_result_stats(student_data: dict) -> str:
+    values = result_stats_values(student_data)
 
     stats = (
         f"📊 <b>Result Statistics</b>\n"
-        f"📚 Total Courses: {total_courses}\n"
+        f"📚 Total Courses: {values['total_courses']}\n"
     )
-    if scores:
-        stats += f"📈 Average Score: {avg_score:.2f}\n"
-    if courses and 'status' in courses[0]:
-        stats += f"✅ Passed: {passed}\n🚫 Failed: {total_courses - passed}"
+    if values['scores']:
+        stats += f"📈 Average Score: {values['average_score']:.2f}\n"
+    if values['has_status']:
+        stats += f"✅ Passed: {values['passed']}\n🚫 Failed: {values['failed']}"
     else:
         stats += "ℹ️ Pass/Fail status not available"
     
     return stats
 
+# Channel membership answered from memory; chat_member updates keep entries fresh
+MEMBER_STATUSES = ["member", "administrator", "creator"]
+
+class MembershipCache:
+    def __init__(self, maxsize: int, ttl: int, negative_ttl: int, fallback: str):
+        self.members = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.non_members = TTLCache(maxsize=maxsize, ttl=negative_ttl)
+        self.last_known = LRUCache(maxsize=maxsize)
+        self.fallback_policy = fallback
+        self.stats = {"hits": 0, "misses": 0, "updates": 0, "errors": 0, "stale_served": 0, "allowed": 0}
+
+    def get(self, user_id: int):
+        if user_id in self.members:
+            self.stats["hits"] += 1
+            return True
+        if user_id in self.non_members:
+            self.stats["hits"] += 1
+            return False
+        self.stats["misses"] += 1
+        return None
+
+    def set(self, user_id: int, is_member: bool):
+        self.last_known[user_id] = is_member
+        if is_member:
+            self.members[user_id] = True
+            self.non_members.pop(user_id, None)
+        else:
+            self.non_members[user_id] = True
+            self.members.pop(user_id, None)
+
+    def fallback(self, user_id: int) -> bool:
+        self.stats["errors"] += 1
+        if self.fallback_policy == "allow":
+            self.stats["allowed"] += 1
+            return True
+        if self.fallback_policy == "stale" and user_id in self.last_known:
+            self.stats["stale_served"] += 1
+            return self.last_known[user_id]
+        return False
+
+membership_cache = MembershipCache(
+    MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL, MEMBERSHIP_NEGATIVE_TTL, MEMBERSHIP_FALLBACK
+)
+
 # Check if user is a member of the channel
 async def is_user_member(update: Update, context: CallbackContext) -> bool:
+    user_id = update.effective_user.id
+    cached = membership_cache.get(user_id)
+    if cached is not None:
+        return cached
     try:
-        chat_member = await context.bot.get_chat_member(chat_id=CHANNEL_ID, user_id=update.effective_user.id)
-        return chat_member.status in ["member", "administrator", "creator"]
+        chat_member = await asyncio.wait_for(
+            context.bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id), MEMBERSHIP_CHECK_TIMEOUT
+        )
     except Exception as e:
-        logger.error(f"Error checking channel membership: {e}")
-        return False
+        logger.error(f"Error checking channel membership: {e!r}")
+        return membership_cache.fallback(user_id)
+    is_member = chat_member.status in MEMBER_STATUSES
+    membership_cache.set(user_id, is_member)
+    return is_member
+
+def is_channel(chat) -> bool:
+    if str(CHANNEL_ID).startswith("@"):
+        return chat.username is not None and f"@{chat.username}".lower() == CHANNEL_ID.lower()
+    return str(chat.id) == str(CHANNEL_ID)
+
+async def track_channel_membership(update: Update, context: CallbackContext) -> None:
+    member_update = update.chat_member
+    if not is_channel(member_update.chat):
+        return
+    new_member = member_update.new_chat_member
+    membership_cache.stats["updates"] += 1
+    membership_cache.set(new_member.user.id, new_member.status in MEMBER_STATUSES)
+
+# Bounded FIFO in front of interactive lookups: a global running cap, one lookup per user,
+# and a waiting room that turns people away when full instead of letting everyone time out
+class LookupRejected(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+class LookupQueue:
+    def __init__(self, workers: int, limit: int, progress_interval: float):
+        self.workers = workers
+        self.limit = limit
+        self.progress_interval = progress_interval
+        self.running = 0
+        self.waiting = deque()
+        self.users = set()
+        self.service_time = 5.0  # seconds, moving average of recent lookups
+        self.stats = {"admitted": 0, "queued": 0, "full": 0, "duplicate": 0}
+
+    def admit(self, user_id: int) -> dict:
+        if user_id in self.users:
+            self.stats["duplicate"] += 1
+            raise LookupRejected("duplicate")
+        ticket = {"user_id": user_id, "granted": None, "started": None}
+        if self.running < self.workers and not self.waiting:
+            self.running += 1
+            ticket["started"] = time.monotonic()
+        elif len(self.waiting) >= self.limit:
+            self.stats["full"] += 1
+            raise LookupRejected("full")
+        else:
+            ticket["granted"] = asyncio.get_running_loop().create_future()
+            self.waiting.append(ticket)
+            self.stats["queued"] += 1
+        self.users.add(user_id)
+        self.stats["admitted"] += 1
+        return ticket
+
+    def position(self, ticket: dict) -> int:
+        try:
+            return self.waiting.index(ticket) + 1
+        except ValueError:
+            return 0
+
+    def estimated_wait(self, position: int) -> float:
+        return self.service_time * -(-position // self.workers)
+
+    async def wait_turn(self, ticket: dict, on_position) -> None:
+        shown = None
+        try:
+            while ticket["started"] is None:
+                position = self.position(ticket)
+                if position != shown:
+                    shown = position
+                    try:
+                        await on_position(position, self.estimated_wait(position))
+                    except TelegramError as e:
+                        logger.debug(f"Could not show queue position: {e}")
+                try:
+                    # Wake at most once per interval to refresh the position shown to the user
+                    await asyncio.wait_for(asyncio.shield(ticket["granted"]), self.progress_interval)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self.release(ticket)
+            raise
+
+    def release(self, ticket: dict) -> None:
+        if ticket["user_id"] not in self.users:
+            return
+        self.users.discard(ticket["user_id"])
+        if ticket["started"] is None:
+            self.waiting.remove(ticket)
+            return
+        self.service_time = 0.8 * self.service_time + 0.2 * (time.monotonic() - ticket["started"])
+        self.running -= 1
+        while self.waiting and self.running < self.workers:
+            waiter = self.waiting.popleft()
+            waiter["started"] = time.monotonic()
+            self.running += 1
+            waiter["granted"].set_result(None)
+
+lookup_queue = LookupQueue(LOOKUP_WORKERS, LOOKUP_QUEUE_LIMIT, LOOKUP_PROGRESS_INTERVAL)
+metrics.gauge("bot_lookup_queue", "Interactive lookups by state", lambda: {
+    (("state", "running"),): lookup_queue.running,
+    (("state", "waiting"),): len(lookup_queue.waiting),
+})
 
 # Notify admins
 async def notify_admins(context: CallbackContext, message: str):
@@ -184,6 +2218,89 @@ async def notify_admins(context: CallbackContext, message: str):
         except Exception as e:
             logger.error(f"Failed to notify admin {admin_id}: {e}")
 
+# Result card shown to users
+def format_student_result(student_data: dict) -> str:
+    student = student_data.get("student", {})
+    courses = student_data.get("courses", [])
+
+    message = (
+        f"🎓 <b>Student Result</b>\n\n"
+        f"👤 <b>Name:</b> {student.get('name', 'N/A')}\n"
+        f"🎂 <b>Age:</b> {student.get('age', 'N/A')}\n"
+        f"🏫 <b>School:</b> {student.get('school', 'N/A')}\n"
+        f"📍 <b>Woreda:</b> {student.get('woreda', 'N/A')}\n"
+        f"🚻 <b>Gender:</b> {student.get('gender', 'N/A')}\n"
+        f"📚 <b>Courses:</b>\n"
+    )
+    for course in courses:
+        message += f"📖 • <b>{course.get('name', 'N/A')}</b>\n"
+    return message
+
+# One edit stream per message: at most one edit per interval, and a newer state replaces
+# one that hasn't been shown yet instead of queueing behind it
+class ProgressMessage:
+    def __init__(self, message, interval: float):
+        self.message = message
+        self.interval = interval
+        self.shown = message.text
+        self.pending = None
+        self.last_edit = time.monotonic()  # the message itself was just sent
+        self.editing = False
+        self.closed = False
+        self._task = None
+
+    def update(self, text: str) -> None:
+        if self.closed:
+            return
+        self.pending = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._drain())
+
+    async def _drain(self) -> None:
+        while self.pending is not None and not self.closed:
+            delay = self.last_edit + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            text, self.pending = self.pending, None
+            if text == self.shown:
+                continue
+            self.editing = True
+            try:
+                await timed("progress_edit", self.message.edit_text(text))
+                self.shown = text
+            except TelegramError as e:
+                logger.debug(f"Progress edit failed: {e}")
+            finally:
+                self.editing = False
+                self.last_edit = time.monotonic()
+
+    async def _stop(self) -> None:
+        self.closed = True
+        self.pending = None
+        if self._task and not self._task.done():
+            if self.editing:
+                await self._task  # let an edit already on the wire land before the final one
+            else:
+                self._task.cancel()
+
+    async def finish(self, text: str, **kwargs) -> None:
+        await self._stop()
+        await timed("progress_edit", self.message.edit_text(text, **kwargs))
+        self.shown = text
+
+    async def discard(self) -> None:
+        await self._stop()
+        try:
+            await self.message.delete()
+        except TelegramError as e:
+            logger.debug(f"Could not delete progress message: {e}")
+
+    def close(self) -> None:
+        self.closed = True
+        if self._task and not self._task.done() and not self.editing:
+            self._task.cancel()
+
 # Fetch and send results with photo and statistics
 async def fetch_results(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
@@ -196,81 +2313,477 @@ async def fetch_results(update: Update, context: CallbackContext) -> None:
 
     if not region or not registration or not first_name:
         error_msg = await update.message.reply_text("❌ Missing required information")
-        user_data['message_ids'].append(error_msg.message_id)
+        track_message(user_data, error_msg.message_id)
         return
 
-    conn = sqlite3.connect("bot_data.db")
-    conn.execute(
-        "INSERT INTO usage_logs (user_id, action, timestamp) VALUES (?, ?, ?)",
-        (update.effective_user.id, "result_lookup", datetime.now().isoformat())
+    lang = user_data.get('language', 'en')
+    loading_message = await update.message.reply_text(
+        "🔎 Looking up your result..." if lang == "en" else "🔎 ውጤትዎን በመፈለግ ላይ..."
     )
-    conn.commit()
-    conn.close()
+    track_message(user_data, loading_message.message_id)
+    user_data['last_lookup'] = [region, registration, first_name]
+
+    try:
+        ticket = lookup_queue.admit(update.effective_user.id)
+    except LookupRejected as e:
+        metrics.inc("bot_lookup_rejected_total", reason=e.reason)
+        await loading_message.edit_text(lookup_rejected_text(e.reason, lang))
+        return
+    await run_queued_lookup(update, context, loading_message, ticket, region, registration, first_name)
+
+def format_wait(seconds: float, lang: str) -> str:
+    if seconds < 60:
+        value = max(5, int(round(seconds / 5) * 5))
+        return f"{value} seconds" if lang == "en" else f"{value} ሰከንድ"
+    value = int(round(seconds / 60))
+    return f"{value} min" if lang == "en" else f"{value} ደቂቃ"
+
+def lookup_rejected_text(reason: str, lang: str) -> str:
+    if reason == "duplicate":
+        return (
+            "⏳ Your previous lookup is still in progress. Please wait for it to finish."
+            if lang == "en" else
+            "⏳ ያቀረቡት የቀድሞ ጥያቄ ገና በሂደት ላይ ነው። እባክዎ እስኪጠናቀቅ ይጠብቁ።"
+        )
+    return (
+        "🚦 Lots of students are checking results right now and the queue is full. Please try again in a few minutes."
+        if lang == "en" else
+        "🚦 በአሁኑ ጊዜ ብዙ ተማሪዎች ውጤት እያዩ ነው፤ ወረፋው ሞልቷል። እባክዎ ከጥቂት ደቂቃዎች በኋላ ደግመው ይሞክሩ።"
+    )
+
+async def run_queued_lookup(update: Update, context: CallbackContext, loading_message, ticket: dict,
+                            region: str, registration: str, first_name: str) -> None:
+    lang = context.user_data.get('language', 'en')
+    progress = ProgressMessage(loading_message, PROGRESS_EDIT_INTERVAL)
+
+    async def show_position(position: int, wait: float) -> None:
+        progress.update(
+            f"⏳ You are number {position} in the queue. Estimated wait: about {format_wait(wait, lang)}."
+            if lang == "en" else
+            f"⏳ በወረፋው {position}ኛ ነዎት። የሚገመት የመጠበቂያ ጊዜ፦ {format_wait(wait, lang)} ገደማ።"
+        )
+
+    queued_at = time.monotonic()
+    try:
+        # Queued lookups wait outside the running slots, still inside the chat's lock
+        async with update_processor.slot_released():
+            await lookup_queue.wait_turn(ticket, show_position)
+        metrics.observe("bot_stage_seconds", time.monotonic() - queued_at, stage="queue_wait")
+        progress.update("🔎 Looking up your result..." if lang == "en" else "🔎 ውጤትዎን በመፈለግ ላይ...")
+        await send_results(update, context, progress, region, registration, first_name)
+    finally:
+        progress.close()
+        lookup_queue.release(ticket)
+
+def result_menu_keyboard(share_text: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🏠 Back to Menu", callback_data="back_to_menu")],
+        [InlineKeyboardButton("🔔 Subscribe for Updates", callback_data="subscribe")],
+        [InlineKeyboardButton("📄 Download PDF", callback_data="download_pdf")],
+        [InlineKeyboardButton("📤 Share Result", switch_inline_query=share_text)],
+    ])
+
+def caption_length(html: str) -> int:
+    return len(unescape(re.sub(r"<[^>]+>", "", html)))
+
+# The loading message doubles as the result: one reply, a few throttled edits, then either
+# the photo carrying the whole card and menu, or the card edited in with the photo below it
+async def send_results(update: Update, context: CallbackContext, progress: "ProgressMessage",
+                       region: str, registration: str, first_name: str) -> None:
+    user_data = context.user_data
+    lang = user_data.get('language', 'en')
+    started = time.monotonic()
+    try:
+        student_data = await timed("data_fetch", fetch_student_data(region, registration, first_name))
+    except RegionOverloaded:
+        log_usage(update.effective_user.id, "result_lookup_overloaded", region)
+        metrics.observe("bot_lookup_seconds", time.monotonic() - started, outcome="overloaded")
+        await progress.finish(
+            "⚠️ The results site for your region is overloaded right now. Please try again in a few minutes."
+            if lang == "en" else
+            "⚠️ የክልልዎ የውጤት ድረ-ገጽ በአሁኑ ጊዜ ተጨናንቋል። እባክዎ ከጥቂት ደቂቃዎች በኋላ ደግመው ይሞክሩ።"
+        )
+        return
+    log_usage(update.effective_user.id, "result_lookup", region, (time.monotonic() - started) * 1000)
+    if not student_data:
+        metrics.observe("bot_lookup_seconds", time.monotonic() - started, outcome="not_found")
+        await progress.finish("🔴 No data found. Please check your details and try again.")
+        return
+
+    student = student_data.get("student", {})
+    photo_url = student['photo'].replace("\\", "") if student.get('photo') else None
+    # Start on the photo right away; the card is built while it downloads
+    photo_task = asyncio.ensure_future(prepare_student_photo(photo_url)) if photo_url else None
+    progress.update("🖼 Preparing your result card..." if lang == "en" else "🖼 የውጤት ካርድዎን በማዘጋጀት ላይ...")
+
+    message = format_student_result(student_data)
+    card = message + "\n" + calculate_result_stats(student_data)
+    keyboard = result_menu_keyboard(message)
+    try:
+        photo = await photo_task if photo_task else None
+    except Exception as e:
+        logger.error(f"Error preparing photo: {e}")
+        photo = None
+
+    if photo is not None and caption_length(card) <= PHOTO_CAPTION_LIMIT:
+        photo_message = await send_student_photo(update, photo_url, card, reply_markup=keyboard, photo=photo)
+        if photo_message:
+            track_message(user_data, photo_message.message_id)
+            await progress.discard()
+            metrics.observe("bot_lookup_seconds", time.monotonic() - started, outcome="found")
+            return
+        photo = None
+
+    if photo is None:
+        await progress.finish(card + "\n📷 <i>Photo unavailable</i>", parse_mode='HTML', reply_markup=keyboard)
+    else:
+        await progress.finish(card, parse_mode='HTML')
+        caption = f"👤 <b>{escape(str(student.get('name', '')))}</b>"
+        photo_message = await send_student_photo(update, photo_url, caption, reply_markup=keyboard, photo=photo)
+        if photo_message:
+            track_message(user_data, photo_message.message_id)
+        else:
+            await progress.finish(card + "\n📷 <i>Photo unavailable</i>", parse_mode='HTML', reply_markup=keyboard)
+    metrics.observe("bot_lookup_seconds", time.monotonic() - started, outcome="found")
+
+# Bulk lookups: rows from an uploaded CSV run through a bounded worker pool on the normal fetch path
+BULK_COLUMNS = [
+    "region", "registration", "first_name", "status", "name", "age", "school", "woreda", "gender",
+    "courses", "total_courses", "average_score", "passed", "failed",
+]
+
+def parse_bulk_csv(content: str) -> tuple:
+    rows, errors = [], []
+    for line_number, row in enumerate(csv.reader(StringIO(content)), start=1):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        if line_number == 1 and [cell.strip().lower() for cell in row[:3]] == ["region", "registration", "first_name"]:
+            continue
+        if len(row) < 3:
+            errors.append(f"line {line_number}: expected region, registration, first_name")
+            continue
+        region, registration, first_name = (cell.strip() for cell in row[:3])
+        region = region.lower()
+        if region not in REGION_BASE_URLS:
+            errors.append(f"line {line_number}: unknown region {region!r}")
+        elif not validate_registration(registration):
+            errors.append(f"line {line_number}: invalid registration {registration!r}")
+        elif not validate_first_name(first_name):
+            errors.append(f"line {line_number}: invalid first name {first_name!r}")
+        else:
+            rows.append((region, registration, first_name.lower()))
+    return rows, errors
+
+async def bulk_lookup_row(user_id: int, row: tuple) -> dict:
+    region, registration, first_name = row
+    record = {"region": region, "registration": registration, "first_name": first_name}
+    started = time.monotonic()
+    try:
+        student_data = await fetch_student_data(region, registration, first_name, raise_errors=True)
+    except RegionOverloaded:
+        record["status"] = "region_overloaded"
+        return record
+    except LookupFailed:
+        # Upstream or proxy trouble, not a missing student; a retry may well find it
+        record["status"] = "error"
+        return record
+    log_usage(user_id, "bulk_lookup", region, (time.monotonic() - started) * 1000)
+    if not student_data:
+        record["status"] = "not_found"
+        return record
+    student = student_data.get("student", {})
+    values = result_stats_values(student_data)
+    record.update({
+        "status": "found",
+        "name": student.get("name", ""),
+        "age": student.get("age", ""),
+        "school": student.get("school", ""),
+        "woreda": student.get("woreda", ""),
+        "gender": student.get("gender", ""),
+        "courses": "; ".join(course.get("name", "") for course in student_data.get("courses", [])),
+        "total_courses": values["total_courses"],
+        "average_score": f"{values['average_score']:.2f}" if values["scores"] else "",
+        "passed": values["passed"] if values["has_status"] else "",
+        "failed": values["failed"] if values["has_status"] else "",
+    })
+    return record
+
+def bulk_summary(records: list, parse_errors: list, elapsed: float) -> str:
+    found = [record for record in records if record["status"] == "found"]
+    not_found = sum(1 for record in records if record["status"] == "not_found")
+    failed = len(records) - len(found) - not_found
+    averages = [float(record["average_score"]) for record in found if record["average_score"] != ""]
+    with_status = [record for record in found if record["passed"] != ""]
+    summary = (
+        f"📊 <b>Bulk Lookup Summary</b>\n"
+        f"📄 Rows: {len(records)} ({len(parse_errors)} skipped)\n"
+        f"✅ Found: {len(found)}\n"
+        f"🔴 Not Found: {not_found}\n"
+        f"⚠️ Failed: {failed}\n"
+    )
+    if averages:
+        summary += f"📈 Class Average Score: {sum(averages) / len(averages):.2f}\n"
+    if with_status:
+        summary += (
+            f"🎓 Passed All Courses: {sum(1 for record in with_status if record['failed'] == 0)}"
+            f"/{len(with_status)}\n"
+        )
+    summary += f"⏱ Took {elapsed:.0f}s"
+    return summary
+
+async def run_bulk_lookup(bot, chat_id: int, user_id: int, rows: list, parse_errors: list) -> None:
+    progress_message = await bot.send_message(chat_id=chat_id, text=f"⏳ Bulk lookup: 0/{len(rows)}")
+    try:
+        await process_bulk_lookup(bot, chat_id, user_id, rows, parse_errors, progress_message)
+    except Exception as e:
+        logger.error(f"Bulk lookup for {chat_id} failed: {e}")
+        try:
+            await progress_message.edit_text("❌ Bulk lookup failed. Please try again later.")
+        except TelegramError as edit_error:
+            logger.warning(f"Could not update bulk progress: {edit_error}")
+
+async def process_bulk_lookup(bot, chat_id: int, user_id: int, rows: list, parse_errors: list, progress_message) -> None:
+    started = time.monotonic()
+    records = [None] * len(rows)
+    done = 0
+    pending = asyncio.Queue()
+    for index, row in enumerate(rows):
+        pending.put_nowait((index, row))
+
+    async def worker():
+        nonlocal done
+        while True:
+            try:
+                index, row = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            records[index] = await bulk_lookup_row(user_id, row)
+            done += 1
+
+    async def report_progress():
+        shown = 0
+        while True:
+            await asyncio.sleep(BULK_PROGRESS_INTERVAL)
+            if done != shown:
+                shown = done
+                try:
+                    await progress_message.edit_text(f"⏳ Bulk lookup: {done}/{len(rows)}")
+                except TelegramError as e:
+                    logger.warning(f"Could not update bulk progress: {e}")
+
+    reporter = asyncio.ensure_future(report_progress())
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(BULK_WORKERS, len(rows)))))
+    finally:
+        reporter.cancel()
+
+    output = StringIO()
+    writer = csv.DictWriter(output, fieldnames=BULK_COLUMNS, restval="")
+    writer.writeheader()
+    writer.writerows(records)
+    document = BytesIO(output.getvalue().encode("utf-8-sig"))
+    summary = bulk_summary(records, parse_errors, time.monotonic() - started)
+    await progress_message.edit_text(f"✅ Bulk lookup complete: {len(rows)}/{len(rows)}")
+    await bot.send_document(
+        chat_id=chat_id,
+        document=document,
+        filename=f"results_{datetime.now():%Y%m%d_%H%M}.csv",
+        caption=summary,
+        parse_mode='HTML'
+    )
+
+# PDF result sheets, rendered in worker processes so the event loop never runs reportlab
+_pdf_assets = None
+
+def init_pdf_worker(font_path: str = ""):
+    # Built once per worker process and reused for every render
+    global _pdf_assets
+    from reportlab.lib import colors
+    from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+    from reportlab.lib.units import mm
+    from reportlab.platypus import TableStyle
+
+    font, bold_font = "Helvetica", "Helvetica-Bold"
+    if font_path:
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        pdfmetrics.registerFont(TTFont("ResultFont", font_path))
+        font = bold_font = "ResultFont"
+
+    sample = getSampleStyleSheet()
+    _pdf_assets = {
+        "mm": mm,
+        "title": ParagraphStyle("ResultTitle", parent=sample["Title"], fontName=bold_font, fontSize=18),
+        "heading": ParagraphStyle("ResultHeading", parent=sample["Heading2"], fontName=bold_font, spaceBefore=8),
+        "body": ParagraphStyle("ResultBody", parent=sample["BodyText"], fontName=font, fontSize=10),
+        "footer": ParagraphStyle("ResultFooter", parent=sample["BodyText"], fontName=font, fontSize=8,
+                                 textColor=colors.grey),
+        "details_table": TableStyle([
+            ("FONTNAME", (0, 0), (0, -1), bold_font),
+            ("FONTNAME", (1, 0), (1, -1), font),
+            ("VALIGN", (0, 0), (-1, -1), "TOP"),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 4),
+        ]),
+        "courses_table": TableStyle([
+            ("FONTNAME", (0, 0), (-1, 0), bold_font),
+            ("FONTNAME", (0, 1), (-1, -1), font),
+            ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#1f4e79")),
+            ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+            ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.HexColor("#eef3f8")]),
+            ("GRID", (0, 0), (-1, -1), 0.5, colors.HexColor("#b0b7c3")),
+        ]),
+    }
+
+def render_result_pdf(student_data: dict, photo: bytes = None) -> bytes:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import Image, Paragraph, SimpleDocTemplate, Spacer, Table
+
+    if _pdf_assets is None:
+        init_pdf_worker(PDF_FONT_PATH)
+    assets = _pdf_assets
+    mm = assets["mm"]
+    student = student_data.get("student", {})
+    courses = student_data.get("courses", [])
+    values = result_stats_values(student_data)
+
+    def cell(value, style="body"):
+        return Paragraph(escape(str(value if value not in (None, "") else "N/A")), assets[style])
+
+    details = Table(
+        [[cell(label), cell(student.get(key))] for label, key in (
+            ("Name", "name"), ("Age", "age"), ("School", "school"), ("Woreda", "woreda"), ("Gender", "gender"),
+        )],
+        colWidths=[30 * mm, 100 * mm],
+        style=assets["details_table"],
+    )
+    header = details
+    if photo:
+        try:
+            header = Table(
+                [[details, Image(BytesIO(photo), width=35 * mm, height=45 * mm, kind="proportional")]],
+                colWidths=[135 * mm, 40 * mm],
+            )
+        except Exception:
+            header = details
+
+    has_scores = any('score' in course for course in courses)
+    course_rows = [["Course"] + (["Score"] if has_scores else []) + (["Status"] if values["has_status"] else [])]
+    for course in courses:
+        row = [cell(course.get("name"))]
+        if has_scores:
+            row.append(cell(course.get("score")))
+        if values["has_status"]:
+            row.append(cell(course.get("status")))
+        course_rows.append(row)
+
+    summary = [f"Total Courses: {values['total_courses']}"]
+    if values["scores"]:
+        summary.append(f"Average Score: {values['average_score']:.2f}")
+    if values["has_status"]:
+        summary.append(f"Passed: {values['passed']}    Failed: {values['failed']}")
+    else:
+        summary.append("Pass/Fail status not available")
+
+    story = [
+        Paragraph("Ethiopian Student Result", assets["title"]),
+        header,
+        Paragraph("Courses", assets["heading"]),
+    ]
+    if courses:
+        story.append(Table(course_rows, repeatRows=1, hAlign="LEFT", style=assets["courses_table"]))
+    else:
+        story.append(cell("No courses listed"))
+    story.append(Paragraph("Result Statistics", assets["heading"]))
+    story.extend(cell(line) for line in summary)
+    story.append(Spacer(1, 10 * mm))
+    story.append(Paragraph(escape(f"Generated {datetime.now():%Y-%m-%d %H:%M}"), assets["footer"]))
+
+    buffer = BytesIO()
+    SimpleDocTemplate(
+        buffer, pagesize=A4, title=f"Result - {student.get('name', '')}",
+        leftMargin=18 * mm, rightMargin=18 * mm, topMargin=18 * mm, bottomMargin=18 * mm,
+    ).build(story)
+    return buffer.getvalue()
+
+pdf_executor = None
+
+def get_pdf_executor() -> concurrent.futures.ProcessPoolExecutor:
+    global pdf_executor
+    if pdf_executor is None:
+        # Spawned, not forked: by now the storage writer and thread pools may hold locks a fork would copy
+        pdf_executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=PDF_WORKERS, initializer=init_pdf_worker, initargs=(PDF_FONT_PATH,),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return pdf_executor
+
+def shutdown_pdf_executor():
+    global pdf_executor
+    if pdf_executor is not None:
+        pdf_executor.shutdown(wait=False, cancel_futures=True)
+        pdf_executor = None
 
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    loading_message = await update.message.reply_text("⬜⬜⬜⬜ (0%)")
-    user_data['message_ids'].append(loading_message.message_id)
+async def send_result_pdf(update: Update, context: CallbackContext) -> None:
+    user_data = context.user_data
+    lang = user_data.get('language', 'en')
+    lookup = user_data.get('last_lookup')
+    chat_id = update.effective_chat.id
+    if not lookup:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="❌ Please check your result again first." if lang == "en" else "❌ እባክዎ መጀመሪያ ውጤትዎን ደግመው ይመልከቱ።"
+        )
+        return
+    region, registration, first_name = lookup
+    filename = f"result_{registration}.pdf"
+    load_failed = "❌ Could not load your result. Please try again later." if lang == "en" else "❌ ውጤትዎን መጫን አልተቻለም። እባክዎ ቆይተው ይሞክሩ።"
 
-    student_data = await fetch_student_data(region, registration, first_name)
+    try:
+        student_data = await fetch_student_data(region, registration, first_name)
+    except RegionOverloaded:
+        student_data = None
     if not student_data:
-        await loading_message.edit_text("🔴 No data found. Please check your details and try again.")
+        await context.bot.send_message(chat_id=chat_id, text=load_failed)
         return
 
-    await loading_message.edit_text("🟩⬜⬜⬜ (25%)")
-
-    student = student_data.get("student", {})
-    courses = student_data.get("courses", [])
-    
-    message = (
-        f"🎓 <b>Student Result</b>\n\n"
-        f"👤 <b>Name:</b> {student.get('name', 'N/A')}\n"
-        f"🎂 <b>Age:</b> {student.get('age', 'N/A')}\n"
-        f"🏫 <b>School:</b> {student.get('school', 'N/A')}\n"
-        f"📍 <b>Woreda:</b> {student.get('woreda', 'N/A')}\n"
-        f"🚻 <b>Gender:</b> {student.get('gender', 'N/A')}\n"
-        f"📚 <b>Courses:</b>\n"
-    )
-    for course in courses:
-        message += f"📖 • <b>{course.get('name', 'N/A')}</b>\n"
-
-    await loading_message.edit_text("🟩🟩⬜⬜ (50%)")
-
-    photo_bytes = None
-    if 'photo' in student and student['photo']:
-        photo_url = student['photo'].replace("\\", "")
-        photo_bytes = await fetch_student_photo(photo_url)
+    # Keyed by content too, so a refreshed result never reuses the PDF of the old one
+    document_key = f"pdf|{region}|{registration}|{first_name}|{result_fingerprint(student_data)[:16]}"
+    row = await storage.fetchone("SELECT file_id FROM documents WHERE key = ?", (document_key,))
+    if row:
+        try:
+            pdf_message = await context.bot.send_document(chat_id=chat_id, document=row[0], filename=filename)
+            track_message(user_data, pdf_message.message_id)
+            return
+        except BadRequest as e:
+            logger.warning(f"Cached PDF file_id for {document_key} rejected, re-rendering: {e}")
 
-    await loading_message.edit_text("🟩🟩🟩⬜ (75%)")
+    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_DOCUMENT)
+    photo = None
+    photo_url = student_data.get("student", {}).get("photo")
+    if photo_url:
+        photo_bytes = await fetch_student_photo(photo_url.replace("\\", ""))
+        photo = photo_bytes.getvalue() if photo_bytes else None
 
-    if photo_bytes:
-        photo_message = await update.message.reply_photo(
-            photo=photo_bytes,
-            caption=message,
-            parse_mode='HTML'
+    loop = asyncio.get_running_loop()
+    # Handled here: this is a callback-query update, so error_handler has no message to reply to
+    try:
+        pdf_bytes = await loop.run_in_executor(get_pdf_executor(), render_result_pdf, student_data, photo)
+        pdf_message = await context.bot.send_document(
+            chat_id=chat_id, document=BytesIO(pdf_bytes), filename=filename
+        )
+    except Exception as e:
+        if isinstance(e, concurrent.futures.BrokenExecutor):
+            # A crashed render worker breaks the whole pool; the next request starts a new one
+            shutdown_pdf_executor()
+        logger.error(f"Error sending result PDF for {registration}: {e}")
+        await context.bot.send_message(chat_id=chat_id, text=load_failed)
+        return
+    track_message(user_data, pdf_message.message_id)
+    if pdf_message.document:
+        storage.write(
+            "INSERT OR REPLACE INTO documents (key, file_id, updated_at) VALUES (?, ?, ?)",
+            (document_key, pdf_message.document.file_id, datetime.now().isoformat())
         )
-        user_data['message_ids'].append(photo_message.message_id)
-    else:
-        result_message = await update.message.reply_text(
-            message + "\n📷 <i>Photo unavailable</i>",
-            parse_mode='HTML'
-        )
-        user_data['message_ids'].append(result_message.message_id)
-
-    stats_message_text = calculate_result_stats(student_data)
-    stats_message = await update.message.reply_text(stats_message_text, parse_mode='HTML')
-    user_data['message_ids'].append(stats_message.message_id)
-
-    await loading_message.edit_text("🟩🟩🟩🟩 (100%)")
-    await loading_message.edit_text("✅ Request completed!")
-    menu_message = await update.message.reply_text(
-        "🎓 Here are your results and stats above. What would you like to do next?",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🏠 Back to Menu", callback_data="back_to_menu")],
-            [InlineKeyboardButton("🔔 Subscribe for Updates", callback_data="subscribe")],
-            [InlineKeyboardButton("📤 Share Result", switch_inline_query=message)],
-        ]),
-    )
-    user_data['message_ids'].append(menu_message.message_id)
 
 # Input validation
 def validate_registration(registration: str) -> bool:
@@ -321,7 +2834,8 @@ async def start(update: Update, context: CallbackContext) -> int:
         error_msg = await update.message.reply_text(
             f"🚫 You must join our channel to use this bot.\n\nPlease join {CHANNEL_ID} and try again."
         )
-        context.user_data['message_ids'] = [update.message.message_id, error_msg.message_id]
+        context.user_data['message_ids'] = []
+        track_message(context.user_data, update.message.message_id, error_msg.message_id)
         return ConversationHandler.END
 
     user_id = update.effective_user.id
@@ -341,12 +2855,13 @@ async def start(update: Update, context: CallbackContext) -> int:
         )
     await notify_admins(context, notification)
 
-    context.user_data['message_ids'] = [update.message.message_id]
+    context.user_data['message_ids'] = []
+    track_message(context.user_data, update.message.message_id)
     lang_msg = await update.message.reply_text(
         "🌍 Please choose your language:\n\n🌍 እባክዎ ቋንቋዎን ይምረጡ:",
         reply_markup=language_menu_keyboard()
     )
-    context.user_data['message_ids'].append(lang_msg.message_id)
+    track_message(context.user_data, lang_msg.message_id)
     return LANGUAGE
 
 async def select_language(update: Update, context: CallbackContext) -> int:
@@ -397,31 +2912,31 @@ async def get_registration(update: Update, context: CallbackContext) -> int:
     user_data = context.user_data
     if 'message_ids' not in user_data:
         user_data['message_ids'] = []
-    user_data['message_ids'].append(update.message.message_id)
+    track_message(user_data, update.message.message_id)
 
     registration = update.message.text
     if not validate_registration(registration):
         text = "❌ Invalid registration number. Try again." if user_data.get('language') == "en" else "❌ የማያገለግል የምዝገባ ቁጥር። እባክዎ ደግመው ይሞክሩ።"
         error_msg = await update.message.reply_text(text)
-        user_data['message_ids'].append(error_msg.message_id)
+        track_message(user_data, error_msg.message_id)
         return REGISTRATION
     user_data['registration'] = registration
     text = "📝 Now please enter your first name:" if user_data.get('language') == "en" else "📝 እባክዎ የእርስዎን የመጀመሪያ ስም ያስገቡ:"
     prompt_msg = await update.message.reply_text(text)
-    user_data['message_ids'].append(prompt_msg.message_id)
+    track_message(user_data, prompt_msg.message_id)
     return FIRST_NAME
 
 async def get_first_name(update: Update, context: CallbackContext) -> int:
     user_data = context.user_data
     if 'message_ids' not in user_data:
         user_data['message_ids'] = []
-    user_data['message_ids'].append(update.message.message_id)
+    track_message(user_data, update.message.message_id)
 
     first_name = update.message.text
     if not validate_first_name(first_name):
         text = "❌ Invalid first name. Try again." if user_data.get('language') == "en" else "❌ የማያገለግል የመጀመሪያ ስም። እባክዎ ደግመው ይሞክሩ።"
         error_msg = await update.message.reply_text(text)
-        user_data['message_ids'].append(error_msg.message_id)
+        track_message(user_data, error_msg.message_id)
         return FIRST_NAME
     user_data['first_name'] = first_name
     await fetch_results(update, context)
@@ -442,15 +2957,15 @@ async def feedback_start(update: Update, context: CallbackContext) -> int:
         lang = user_data.get('language', 'en')
         text = "📝 Please type your feedback:" if lang == "en" else "📝 እባክዎ አስተያየትዎን ይፃፉ:"
         prompt_msg = await update.message.reply_text(text)
-        user_data['message_ids'].append(update.message.message_id)
-        user_data['message_ids'].append(prompt_msg.message_id)
+        track_message(user_data, update.message.message_id)
+        track_message(user_data, prompt_msg.message_id)
     return FEEDBACK
 
 async def receive_feedback(update: Update, context: CallbackContext) -> int:
     user_data = context.user_data
     if 'message_ids' not in user_data:
         user_data['message_ids'] = []
-    user_data['message_ids'].append(update.message.message_id)
+    track_message(user_data, update.message.message_id)
 
     user_id = update.effective_user.id
     username = update.effective_user.username or "No username"
@@ -462,17 +2977,17 @@ async def receive_feedback(update: Update, context: CallbackContext) -> int:
             if user_data.get('language', 'en') == "en"
             else "❌ አስተያየት ባዶ መሆን አይችልም። እባክዎ ደግመው ይሞክሩ።"
         )
-        user_data['message_ids'].append(error_msg.message_id)
+        track_message(user_data, error_msg.message_id)
         return FEEDBACK
 
     try:
-        save_feedback(user_id, feedback_text)
+        await save_feedback(user_id, feedback_text)
         lang = user_data.get('language', 'en')
         success_msg = await update.message.reply_text(
             "✅ Thank you for your feedback!" if lang == "en" else "✅ ለአስተያየትዎ እናመሰግናለን!",
             reply_markup=main_menu_keyboard() if lang == "en" else main_menu_keyboard_amharic()
         )
-        user_data['message_ids'].append(success_msg.message_id)
+        track_message(user_data, success_msg.message_id)
         await notify_admins(
             context,
             f"📬 <b>New Feedback</b>\n👤 <b>ID:</b> {user_id}\n🔗 <b>Username:</b> @{username}\n📝 <b>Message:</b> {feedback_text}"
@@ -485,9 +3000,52 @@ async def receive_feedback(update: Update, context: CallbackContext) -> int:
             if user_data.get('language', 'en') == "en"
             else "❌ አስተያየትዎን በማስገባት ላይ ስህተት ተከስቷል። እባክዎ ቆይተው ይሞክሩ።"
         )
-        user_data['message_ids'].append(error_msg.message_id)
+        track_message(user_data, error_msg.message_id)
         return FEEDBACK
 
+def is_bulk_user(user_id: int) -> bool:
+    return user_id in ADMIN_IDS or user_id in BULK_USER_IDS
+
+async def bulk_start(update: Update, context: CallbackContext) -> int:
+    if not is_bulk_user(update.effective_user.id):
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return ConversationHandler.END
+    await update.message.reply_text(
+        f"📄 Send a CSV file with one student per row: region, registration, first_name\n"
+        f"Regions: {', '.join(REGION_BASE_URLS)}. Up to {BULK_MAX_ROWS} rows."
+    )
+    return BULK_UPLOAD
+
+async def receive_bulk_csv(update: Update, context: CallbackContext) -> int:
+    document = update.message.document
+    if document.file_size and document.file_size > BULK_MAX_FILE_BYTES:
+        await update.message.reply_text(f"❌ File too large. The limit is {BULK_MAX_FILE_BYTES // 1024} KB.")
+        return BULK_UPLOAD
+    file = await document.get_file()
+    content = bytes(await file.download_as_bytearray()).decode("utf-8-sig", errors="replace")
+    rows, parse_errors = parse_bulk_csv(content)
+    if not rows:
+        await update.message.reply_text(
+            "❌ No valid rows found.\n" + "\n".join(parse_errors[:10])
+        )
+        return BULK_UPLOAD
+    if len(rows) > BULK_MAX_ROWS:
+        await update.message.reply_text(f"❌ Too many rows ({len(rows)}). The limit is {BULK_MAX_ROWS}.")
+        return BULK_UPLOAD
+    if parse_errors:
+        await update.message.reply_text(
+            f"⚠️ Skipping {len(parse_errors)} invalid rows:\n" + "\n".join(parse_errors[:10])
+        )
+    # Run in the background so the chat stays responsive while the batch is processed
+    context.application.create_task(
+        run_bulk_lookup(context.bot, update.effective_chat.id, update.effective_user.id, rows, parse_errors)
+    )
+    return ConversationHandler.END
+
+async def bulk_invalid_upload(update: Update, context: CallbackContext) -> int:
+    await update.message.reply_text("📄 Please send the student list as a .csv file.")
+    return BULK_UPLOAD
+
 async def check_result_start(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     await query.answer()
@@ -535,13 +3093,7 @@ async def button_handler(update: Update, context: CallbackContext) -> int:
     elif query.data in ["feedback", "feedback_amharic"]:
         return await feedback_start(update, context)
     elif query.data == "back_to_menu":
-        if 'message_ids' in user_data:
-            for msg_id in user_data['message_ids']:
-                try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-                except Exception as e:
-                    logger.error(f"Error deleting message {msg_id}: {e}")
-        
+        message_ids = deletable_message_ids(user_data)
         user_data.clear()
         text = "🌟 Welcome back! Please choose an option:"
         new_menu_msg = await context.bot.send_message(
@@ -549,15 +3101,241 @@ async def button_handler(update: Update, context: CallbackContext) -> int:
             text=text,
             reply_markup=main_menu_keyboard() if lang == "en" else main_menu_keyboard_amharic()
         )
-        user_data['message_ids'] = [new_menu_msg.message_id]
+        user_data['message_ids'] = []
+        track_message(user_data, new_menu_msg.message_id)
+        if message_ids:
+            # Clean up in the background so the new menu shows up right away
+            context.application.create_task(delete_messages(context.bot, chat_id, message_ids))
+    elif query.data == "download_pdf":
+        await send_result_pdf(update, context)
     elif query.data == "subscribe":
         user_id = update.effective_user.id
-        add_subscriber(user_id)
+        add_subscriber(user_id, *(user_data.get('last_lookup') or [None, None, None]))
         subscribed_users.add(user_id)
         text = "🔔 You are now subscribed to receive updates when your final marks are released!" if lang == "en" else "🔔 የመጨረሻ ክፍል ውጤቶች ሲለቀቁ ለማሳወቅ ተመዝግበዋል!"
         await query.edit_message_text(text)
     return ConversationHandler.END
 
+# Token bucket shared by everything that sends in bulk; pause() honours RetryAfter
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = None
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Tracked message ids are stored as [message_id, sent_at] pairs, capped at MESSAGE_TRACK_LIMIT
+def track_message(user_data: dict, *message_ids: int):
+    tracked = user_data.setdefault('message_ids', [])
+    now = int(time.time())
+    tracked.extend([message_id, now] for message_id in message_ids)
+    if len(tracked) > MESSAGE_TRACK_LIMIT:
+        del tracked[:-MESSAGE_TRACK_LIMIT]
+
+def deletable_message_ids(user_data: dict) -> list:
+    cutoff = time.time() - MESSAGE_DELETE_WINDOW
+    message_ids = []
+    for entry in user_data.get('message_ids', []):
+        if isinstance(entry, int):  # tracked before timestamps were recorded
+            message_ids.append(entry)
+        elif entry[1] >= cutoff:
+            message_ids.append(entry[0])
+    return list(dict.fromkeys(message_ids))
+
+delete_bucket = TokenBucket(DELETE_RATE)
+
+async def delete_message_batch(bot, chat_id: int, message_ids: list):
+    if hasattr(bot, "delete_messages"):
+        return await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+    # python-telegram-bot 20.6 predates the deleteMessages wrapper, so call the endpoint directly
+    return await bot._post("deleteMessages", {"chat_id": chat_id, "message_ids": message_ids})
+
+async def delete_message_single(bot, chat_id: int, message_id: int, slots: asyncio.Semaphore):
+    async with slots:
+        while True:
+            await delete_bucket.acquire()
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message_id)
+                return
+            except RetryAfter as e:
+                delete_bucket.pause(float(e.retry_after))
+            except TelegramError as e:
+                logger.warning(f"Error deleting message {message_id}: {e}")
+                return
+
+async def delete_messages(bot, chat_id: int, message_ids: list):
+    leftover = []
+    for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+        batch = message_ids[start:start + DELETE_BATCH_SIZE]
+        await delete_bucket.acquire()
+        try:
+            await delete_message_batch(bot, chat_id, batch)
+        except RetryAfter as e:
+            delete_bucket.pause(float(e.retry_after))
+            leftover.extend(batch)
+        except TelegramError as e:
+            logger.warning(f"Batch delete of {len(batch)} messages failed, deleting one by one: {e}")
+            leftover.extend(batch)
+    if leftover:
+        slots = asyncio.Semaphore(DELETE_CONCURRENCY)
+        await asyncio.gather(*(delete_message_single(bot, chat_id, message_id, slots) for message_id in leftover))
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+broadcast_progress = {}
+
+def prune_subscriber(user_id):
+    subscribed_users.discard(user_id)
+    storage.write("DELETE FROM subscribers WHERE user_id = ?", (user_id,))
+
+async def send_broadcast_message(bot, broadcast_id: int, user_id: int, text: str, progress: dict):
+    attempts = 0
+    status = 'failed'
+    while attempts < BROADCAST_MAX_ATTEMPTS:
+        await broadcast_bucket.acquire()
+        try:
+            await bot.send_message(chat_id=user_id, text=text)
+            status = 'sent'
+            break
+        except RetryAfter as e:
+            # Rate limiting is not the recipient's fault, so it doesn't use up an attempt
+            logger.warning(f"Broadcast {broadcast_id} rate limited, pausing {e.retry_after}s")
+            broadcast_bucket.pause(float(e.retry_after))
+        except Forbidden:
+            prune_subscriber(user_id)
+            status = 'blocked'
+            break
+        except BadRequest as e:
+            logger.error(f"Broadcast {broadcast_id} to {user_id} rejected: {e}")
+            break
+        except TelegramError as e:
+            attempts += 1
+            logger.error(f"Broadcast {broadcast_id} to {user_id} failed (attempt {attempts}): {e}")
+            await asyncio.sleep(min(2 ** attempts, 30))
+    progress[status] += 1
+    storage.write(
+        "UPDATE broadcast_recipients SET status = ? WHERE broadcast_id = ? AND user_id = ?",
+        (status, broadcast_id, user_id)
+    )
+
+def broadcast_lease_deadline() -> str:
+    return (datetime.now() + timedelta(seconds=BROADCAST_LEASE_SECONDS)).isoformat()
+
+# Recipients are claimed in batches by a single UPDATE, so two processes never send to the same user
+async def claim_broadcast_recipients(broadcast_id: int) -> list:
+    claim = f"{INSTANCE_ID}:{os.urandom(4).hex()}"
+    await storage.execute(
+        "UPDATE broadcast_recipients SET status = 'sending', claimed_by = ? WHERE rowid IN ("
+        "SELECT rowid FROM broadcast_recipients WHERE broadcast_id = ? AND status = 'pending' LIMIT ?)",
+        (claim, broadcast_id, BROADCAST_CLAIM_BATCH)
+    )
+    rows = await storage.fetchall(
+        "SELECT user_id FROM broadcast_recipients WHERE broadcast_id = ? AND claimed_by = ? AND status = 'sending'",
+        (broadcast_id, claim)
+    )
+    return [row[0] for row in rows]
+
+async def run_broadcast(context: CallbackContext) -> None:
+    broadcast_id = context.job.data
+    row = await storage.fetchone("SELECT message FROM broadcasts WHERE id = ?", (broadcast_id,))
+    if row is None:
+        return
+    text = f"📢 Update: {row[0]}"
+    progress = broadcast_progress[broadcast_id] = {
+        "sent": 0, "blocked": 0, "failed": 0, "started": time.monotonic(),
+    }
+    lease_lost = False
+
+    async def keep_lease():
+        nonlocal lease_lost
+        while True:
+            await asyncio.sleep(BROADCAST_LEASE_SECONDS / 3)
+            _, renewed = await storage.execute(
+                "UPDATE broadcasts SET lease_until = ? WHERE id = ? AND owner = ?",
+                (broadcast_lease_deadline(), broadcast_id, INSTANCE_ID)
+            )
+            if not renewed:
+                logger.warning(f"Lost the lease on broadcast {broadcast_id}, stopping after the current batch")
+                lease_lost = True
+                return
+
+    lease_keeper = asyncio.ensure_future(keep_lease())
+    try:
+        while not lease_lost:
+            batch = await claim_broadcast_recipients(broadcast_id)
+            if not batch:
+                break
+            recipients = asyncio.Queue()
+            for user_id in batch:
+                recipients.put_nowait(user_id)
+
+            async def worker():
+                while True:
+                    try:
+                        user_id = recipients.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    await send_broadcast_message(context.bot, broadcast_id, user_id, text, progress)
+
+            await asyncio.gather(*(worker() for _ in range(min(BROADCAST_WORKERS, len(batch)))))
+    finally:
+        lease_keeper.cancel()
+    if lease_lost:
+        return
+    await storage.execute(
+        "UPDATE broadcasts SET status = 'done', finished_at = ?, owner = NULL WHERE id = ? AND owner = ?",
+        (datetime.now().isoformat(), broadcast_id, INSTANCE_ID)
+    )
+    progress["finished"] = time.monotonic()
+    await notify_admins(
+        context,
+        f"✅ <b>Broadcast #{broadcast_id} finished</b>\n"
+        f"📨 Sent: {progress['sent']}\n🚫 Blocked: {progress['blocked']}\n❌ Failed: {progress['failed']}"
+    )
+
+# Runs on every process: picks up broadcasts that were never started or whose owner stopped renewing
+async def resume_broadcasts(context: CallbackContext) -> None:
+    now = datetime.now().isoformat()
+    rows = await storage.fetchall(
+        "SELECT id FROM broadcasts WHERE status = 'running' AND (owner IS NULL OR lease_until < ?)", (now,)
+    )
+    for (broadcast_id,) in rows:
+        _, acquired = await storage.execute(
+            "UPDATE broadcasts SET owner = ?, lease_until = ? "
+            "WHERE id = ? AND status = 'running' AND (owner IS NULL OR lease_until < ?)",
+            (INSTANCE_ID, broadcast_lease_deadline(), broadcast_id, now)
+        )
+        if not acquired:
+            continue  # another process got there first
+        # Claimed by the previous owner but never finished; one it was sending as it died may go out twice
+        await storage.execute(
+            "UPDATE broadcast_recipients SET status = 'pending', claimed_by = NULL "
+            "WHERE broadcast_id = ? AND status = 'sending'",
+            (broadcast_id,)
+        )
+        logger.info(f"Resuming broadcast {broadcast_id}")
+        context.job_queue.run_once(run_broadcast, when=0, data=broadcast_id, name=f"broadcast-{broadcast_id}")
+
 async def broadcast(update: Update, context: CallbackContext) -> None:
     if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("🚫 You are not authorized to use this command.")
@@ -566,12 +3344,184 @@ async def broadcast(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text("ℹ️ Usage: /broadcast <message>")
         return
     message = " ".join(context.args)
-    for user_id in subscribed_users:
+    await storage.flush()
+    broadcast_id, _ = await storage.execute(
+        "INSERT INTO broadcasts (message, created_at, owner, lease_until) VALUES (?, ?, ?, ?)",
+        (message, datetime.now().isoformat(), INSTANCE_ID, broadcast_lease_deadline())
+    )
+    _, total = await storage.execute(
+        "INSERT INTO broadcast_recipients (broadcast_id, user_id) SELECT ?, user_id FROM subscribers",
+        (broadcast_id,)
+    )
+    context.job_queue.run_once(run_broadcast, when=0, data=broadcast_id, name=f"broadcast-{broadcast_id}")
+    await update.message.reply_text(
+        f"📢 Broadcast #{broadcast_id} queued for {total} users. Use /broadcast_status to follow progress."
+    )
+
+async def broadcast_status(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+    if context.args:
         try:
-            await context.bot.send_message(chat_id=user_id, text=f"📢 Update: {message}")
-        except Exception as e:
-            logger.error(f"Failed to send message to {user_id}: {e}")
-    await update.message.reply_text(f"✅ Broadcast sent to {len(subscribed_users)} users.")
+            broadcast_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("❌ Broadcast ID must be a number")
+            return
+    else:
+        row = await storage.fetchone("SELECT MAX(id) FROM broadcasts")
+        broadcast_id = row[0] if row else None
+    row = None
+    if broadcast_id is not None:
+        row = await storage.fetchone("SELECT status, created_at FROM broadcasts WHERE id = ?", (broadcast_id,))
+    if not row:
+        await update.message.reply_text("ℹ️ No broadcasts found.")
+        return
+    await storage.flush()
+    counts = dict(await storage.fetchall(
+        "SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY status", (broadcast_id,)
+    ))
+    pending = counts.get('pending', 0) + counts.get('sending', 0)
+    status_message = (
+        f"📢 <b>Broadcast #{broadcast_id}</b> ({row[0]})\n"
+        f"🕒 Created: {row[1]}\n"
+        f"📨 Sent: {counts.get('sent', 0)}\n"
+        f"🚫 Blocked: {counts.get('blocked', 0)}\n"
+        f"❌ Failed: {counts.get('failed', 0)}\n"
+        f"⏳ Pending: {pending}"
+    )
+    progress = broadcast_progress.get(broadcast_id)
+    if progress:
+        done = progress['sent'] + progress['blocked'] + progress['failed']
+        elapsed = progress.get('finished', time.monotonic()) - progress['started']
+        rate = done / elapsed if elapsed > 0 else 0.0
+        status_message += f"\n⚡ Throughput: {rate:.1f} msg/s"
+        if pending and rate > 0:
+            status_message += f"\n⌛ ETA: {timedelta(seconds=int(pending / rate))}"
+    await update.message.reply_text(status_message, parse_mode='HTML')
+
+# Result-release watcher: detect a release from a per-region canary, then push results to subscribers
+release_bucket = TokenBucket(RELEASE_NOTIFY_RATE)
+release_notifications_running = set()
+
+def result_fingerprint(result: dict) -> str:
+    if result is None:
+        return "not_found"
+    return hashlib.sha256(json.dumps(result, sort_keys=True).encode("utf-8")).hexdigest()
+
+async def check_release_canary(region: str) -> bool:
+    registration, first_name = RELEASE_CANARIES[region]
+    try:
+        result = await fetch_student_data_upstream(region, registration, first_name)
+    except StudentNotFound:
+        result = None
+    except Exception as e:
+        logger.warning(f"Release canary for {region} failed: {e!r}")
+        return False
+    fingerprint = result_fingerprint(result)
+    row = await storage.fetchone("SELECT fingerprint, released_at FROM release_watch WHERE region = ?", (region,))
+    now = datetime.now().isoformat()
+    if row is None:
+        # First observation only sets the baseline
+        await storage.execute(
+            "INSERT INTO release_watch (region, fingerprint, checked_at) VALUES (?, ?, ?)", (region, fingerprint, now)
+        )
+        return False
+    released = row[0] != fingerprint and fingerprint != "not_found"
+    if released:
+        logger.info(f"Results for {region} went live")
+        await storage.execute(
+            "UPDATE release_watch SET fingerprint = ?, checked_at = ?, released_at = ? WHERE region = ?",
+            (fingerprint, now, now, region)
+        )
+    else:
+        storage.write("UPDATE release_watch SET checked_at = ? WHERE region = ?", (now, region))
+    return released
+
+async def notify_release_subscriber(bot, region: str, user_id: int, registration: str, first_name: str):
+    await release_bucket.acquire()
+    if registration and first_name:
+        await student_cache.purge(key=(region, registration, first_name))
+        try:
+            student_data = await fetch_student_data(region, registration, first_name, raise_errors=True)
+        except (RegionOverloaded, LookupFailed, UpstreamError) as e:
+            # Left without notified_at, so the next watcher pass retries instead of reporting a miss
+            logger.warning(f"Release lookup for {user_id} failed, will retry: {e}")
+            return False
+        if student_data:
+            text = (
+                "🔔 <b>Your results have been released!</b>\n\n" + format_student_result(student_data) + "\n" +
+                calculate_result_stats(student_data)
+            )
+        else:
+            text = "🔔 Results have been released, but we couldn't find yours yet. Use /start to check again."
+    else:
+        text = "🔔 Results have been released! Use /start to check yours."
+    while True:
+        try:
+            await bot.send_message(chat_id=user_id, text=text, parse_mode='HTML')
+            break
+        except RetryAfter as e:
+            release_bucket.pause(float(e.retry_after))
+            await release_bucket.acquire()
+        except Forbidden:
+            prune_subscriber(user_id)
+            return True
+        except TelegramError as e:
+            logger.error(f"Failed to notify {user_id} of release: {e}")
+            return False
+    storage.write("UPDATE subscribers SET notified_at = ? WHERE user_id = ?", (datetime.now().isoformat(), user_id))
+    return True
+
+async def notify_release_subscribers(bot, region: str, released_at: str):
+    try:
+        rows = await storage.fetchall(
+            "SELECT user_id, registration, first_name FROM subscribers "
+            "WHERE notified_at IS NULL AND (region = ? OR region IS NULL) "
+            "AND (subscribed_at IS NULL OR subscribed_at < ?)",
+            (region, released_at)
+        )
+        pending = asyncio.Queue()
+        for row in rows:
+            pending.put_nowait(row)
+        notified = 0
+
+        async def worker():
+            nonlocal notified
+            while True:
+                try:
+                    user_id, registration, first_name = pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                if await notify_release_subscriber(bot, region, user_id, registration, first_name):
+                    notified += 1
+
+        await asyncio.gather(*(worker() for _ in range(min(RELEASE_NOTIFY_WORKERS, len(rows)))))
+        if rows:
+            logger.info(f"Release notifications for {region}: {notified}/{len(rows)} delivered")
+    finally:
+        release_notifications_running.discard(region)
+
+async def watch_result_release(context: CallbackContext) -> None:
+    for region in RELEASE_CANARIES:
+        if region not in REGION_BASE_URLS or region in release_notifications_running:
+            continue
+        released = await check_release_canary(region)
+        row = await storage.fetchone("SELECT released_at FROM release_watch WHERE region = ?", (region,))
+        if not row or not row[0]:
+            continue
+        # Also picks up notifications left unfinished by a restart
+        await storage.flush()
+        waiting = await storage.fetchone(
+            "SELECT COUNT(*) FROM subscribers WHERE notified_at IS NULL AND (region = ? OR region IS NULL) "
+            "AND (subscribed_at IS NULL OR subscribed_at < ?)",
+            (region, row[0])
+        )
+        if waiting[0]:
+            if released:
+                await notify_admins(context, f"🎉 <b>Results released</b> for {region}, notifying {waiting[0]} subscribers")
+            release_notifications_running.add(region)
+            context.application.create_task(notify_release_subscribers(context.bot, region, row[0]))
 
 async def reply_to_feedback(update: Update, context: CallbackContext) -> None:
     if update.effective_user.id not in ADMIN_IDS:
@@ -584,21 +3534,17 @@ async def reply_to_feedback(update: Update, context: CallbackContext) -> None:
         feedback_id = int(context.args[0])
         reply_message = " ".join(context.args[1:])
         
-        conn = sqlite3.connect("bot_data.db")
-        cursor = conn.execute("SELECT user_id FROM feedback WHERE id = ? AND replied = 0", (feedback_id,))
-        result = cursor.fetchone()
+        result = await storage.fetchone("SELECT user_id FROM feedback WHERE id = ? AND replied = 0", (feedback_id,))
         if result:
             user_id = result[0]
             await context.bot.send_message(
                 chat_id=user_id,
                 text=f"📩 Admin reply to your feedback:\n\n{reply_message}"
             )
-            conn.execute("UPDATE feedback SET replied = 1 WHERE id = ?", (feedback_id,))
-            conn.commit()
+            await storage.execute("UPDATE feedback SET replied = 1 WHERE id = ?", (feedback_id,))
             await update.message.reply_text(f"✅ Reply sent to feedback ID {feedback_id}")
         else:
             await update.message.reply_text("❌ Feedback ID not found or already replied")
-        conn.close()
     except ValueError:
         await update.message.reply_text("❌ Feedback ID must be a number")
     except Exception as e:
@@ -610,41 +3556,798 @@ async def stats(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text("🚫 You are not authorized to view stats.")
         return
 
-    conn = sqlite3.connect("bot_data.db")
-    subscribers = conn.execute("SELECT COUNT(*) FROM subscribers").fetchone()[0]
-    feedback_count = conn.execute("SELECT COUNT(*) FROM feedback").fetchone()[0]
-    lookups = conn.execute("SELECT COUNT(*) FROM usage_logs WHERE action = 'result_lookup'").fetchone()[0]
-    active_users = conn.execute(
-        "SELECT COUNT(DISTINCT user_id) FROM usage_logs WHERE timestamp > ?",
-        ((datetime.now() - timedelta(hours=24)).isoformat(),)
-    ).fetchone()[0]
-    conn.close()
+    now = datetime.now()
+    totals = await storage.fetchall("SELECT action, region, count FROM usage_totals")
+    feedback_count = sum(count for action, _, count in totals if action == 'feedback')
+    region_counts = {region: count for action, region, count in totals if action == 'result_lookup'}
+    lookups = sum(region_counts.values())
+
+    active_users = {}
+    for label, hours in (("1h", 1), ("24h", 24), ("7d", 24 * 7)):
+        active_users[label] = (await storage.fetchone(
+            "SELECT COUNT(*) FROM user_activity WHERE last_seen > ?",
+            ((now - timedelta(hours=hours)).isoformat(),)
+        ))[0]
+
+    since_hour = (now - timedelta(hours=24)).isoformat()[:13]
+    latency_total, latency_count = await storage.fetchone(
+        "SELECT COALESCE(SUM(latency_total), 0), COALESCE(SUM(latency_count), 0) FROM usage_hourly "
+        "WHERE hour >= ? AND action = 'result_lookup'",
+        (since_hour,)
+    )
+    latency_buckets = await storage.fetchall(
+        "SELECT bucket_ms, SUM(count) FROM latency_hourly WHERE hour >= ? GROUP BY bucket_ms", (since_hour,)
+    )
 
+    # Counted in SQLite rather than from subscribed_users, which only covers this worker's users
+    subscriber_count = (await storage.fetchone("SELECT COUNT(*) FROM subscribers"))[0]
+    update_stats = update_processor.stats()
     stats_message = (
         f"📊 <b>Bot Statistics</b>\n\n"
-        f"👥 Total Subscribers: {subscribers}\n"
+        f"👥 Total Subscribers: {subscriber_count}\n"
         f"📝 Feedback Received: {feedback_count}\n"
         f"🔍 Result Lookups: {lookups}\n"
-        f"🕒 Active Users (24h): {active_users}"
+        f"🕒 Active Users: {active_users['1h']} (1h) / {active_users['24h']} (24h) / {active_users['7d']} (7d)\n"
+        f"🔁 Coalesced Lookups: {coalesced_lookups}\n"
+        f"⚙️ Updates: {update_stats['running']}/{update_stats['concurrency']} running, "
+        f"{update_stats['queued']} queued"
     )
+    if region_counts:
+        stats_message += "\n\n🗺 <b>Lookups by Region</b>\n" + "\n".join(
+            f"• {region or 'unknown'}: {count}"
+            for region, count in sorted(region_counts.items(), key=lambda item: -item[1])
+        )
+    if latency_count:
+        stats_message += (
+            f"\n\n⏱ <b>Lookup Latency (24h)</b>\n"
+            f"Avg: {latency_total / latency_count:.0f} ms\n"
+            f"p50: ≤{latency_percentile(latency_buckets, 0.5)} ms / "
+            f"p95: ≤{latency_percentile(latency_buckets, 0.95)} ms"
+        )
     await update.message.reply_text(stats_message, parse_mode='HTML')
 
+async def upstream(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+    lines = [
+        f"• {region}: limit {status['limit']:.1f}, {status['in_flight']} in flight, "
+        f"breaker {status['breaker']} ({status['rejected']} rejected)"
+        for region, status in upstream_status().items()
+    ]
+    await update.message.reply_text(
+        "🌐 <b>Upstream</b>\n\n" + "\n".join(lines) +
+        f"\n\n🔄 Retries: {upstream_stats['retries']}\n"
+        f"🏁 Hedged: {upstream_stats['hedged']} ({upstream_stats['hedge_wins']} won)\n"
+        f"🚦 Lookup Queue: {lookup_queue.running}/{lookup_queue.workers} running, "
+        f"{len(lookup_queue.waiting)}/{lookup_queue.limit} waiting, ~{lookup_queue.service_time:.1f}s each "
+        f"({lookup_queue.stats['full']} turned away, {lookup_queue.stats['duplicate']} duplicates)",
+        parse_mode='HTML'
+    )
+
+async def load_route_pins() -> None:
+    pinned = {region: route for region, route in ROUTE_PINS.items() if route in FETCH_ROUTES}
+    for region, route in await storage.fetchall("SELECT region, route FROM route_pins"):
+        if route in FETCH_ROUTES:
+            pinned[region] = route
+        else:
+            pinned.pop(region, None)
+    route_selector.pinned = pinned
+
+async def refresh_route_pins(context: CallbackContext) -> None:
+    # Pins live in SQLite so a /route on one worker reaches the others
+    await load_route_pins()
+
+async def routes(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+    if context.args:
+        if len(context.args) != 2 or context.args[0] not in REGION_BASE_URLS or \
+                context.args[1] not in list(FETCH_ROUTES) + ["auto"]:
+            await update.message.reply_text(
+                f"Usage: /route <region> <{'|'.join(FETCH_ROUTES)}|auto>\nRegions: {', '.join(REGION_BASE_URLS)}"
+            )
+            return
+        region, route = context.args
+        await storage.execute(
+            "INSERT OR REPLACE INTO route_pins (region, route, pinned_by, pinned_at) VALUES (?, ?, ?, ?)",
+            (region, route, update.effective_user.id, datetime.now().isoformat())
+        )
+        await load_route_pins()
+        await update.message.reply_text(
+            f"📌 {region} pinned to {route}." if route != "auto" else f"🔀 {region} is routed automatically again."
+        )
+        return
+    lines = []
+    for region in REGION_BASE_URLS:
+        pinned = " (pinned)" if region in route_selector.pinned else ""
+        lines.append(f"<b>{region}</b>: using {route_selector.best(region)}{pinned}")
+        for route in FETCH_ROUTES:
+            stats = route_selector.stats.get((region, route))
+            if not stats or not stats.samples:
+                lines.append(f"  • {route}: no data")
+                continue
+            latency = stats.latency()
+            latency_text = f"{latency * 1000:.0f} ms" if latency != float("inf") else "n/a"
+            lines.append(
+                f"  • {route}: {stats.success_rate():.0%} ok, p50 {latency_text}, "
+                f"{len(stats.samples)} recent / {stats.requests} total"
+            )
+    await update.message.reply_text(
+        "🔀 <b>Fetch Routes</b>\n\n" + "\n".join(lines) +
+        f"\n\n🧪 Probes: {route_selector.probes}\n↩️ Fallbacks: {route_selector.fallbacks}",
+        parse_mode='HTML'
+    )
+
+async def cache_info(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+    cache_stats = await student_cache.stats()
+    hits = cache_stats['hits']
+    membership = membership_cache.stats
+    bytes_in = photo_store.stats["bytes_in"]
+    saved = f" ({1 - photo_store.stats['bytes_out'] / bytes_in:.0%} saved)" if bytes_in else ""
+    cache_message = (
+        f"🗄 <b>Result Cache</b>\n\n"
+        f"🧠 Memory Entries: {cache_stats['memory_entries']} (+{cache_stats['negative_entries']} not found)\n"
+        f"💾 Disk Entries: {cache_stats['disk_entries']} ({cache_stats['disk_negative']} not found)\n"
+        f"📦 Disk Size: {cache_stats['disk_bytes'] / 1024:.1f} KB\n"
+        f"🎯 Hits: {hits['memory']} memory / {hits['disk']} disk / {hits['negative']} not found\n"
+        f"❔ Misses: {cache_stats['misses']}\n"
+        f"📈 Hit Ratio: {cache_stats['hit_ratio']:.1%}\n"
+        f"🖼 Photos: {photo_store.stats['file_id_hits']} file_id reuses / "
+        f"{photo_store.stats['store_hits']} local / {photo_store.stats['downloads']} downloads\n"
+        f"🗜 Normalized: {photo_store.stats['normalized']} photos, "
+        f"{photo_store.stats['bytes_in'] / 1024:.1f} KB → {photo_store.stats['bytes_out'] / 1024:.1f} KB"
+        f"{saved}\n"
+        f"👥 Membership: {membership['hits']} hits / {membership['misses']} misses / "
+        f"{membership['updates']} channel updates / {membership['errors']} API errors "
+        f"({membership['stale_served']} stale, {membership['allowed']} allowed)"
+    )
+    await update.message.reply_text(cache_message, parse_mode='HTML')
+
+async def cache_purge(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+    if not context.args or context.args[0] not in ("all", "notfound", "key"):
+        await update.message.reply_text(
+            "ℹ️ Usage: /cache_purge all | notfound | key <region> <registration> <first_name>"
+        )
+        return
+    mode = context.args[0]
+    if mode == "key":
+        if len(context.args) != 4:
+            await update.message.reply_text("ℹ️ Usage: /cache_purge key <region> <registration> <first_name>")
+            return
+        region, registration, first_name = context.args[1], context.args[2], context.args[3].lower()
+        deleted = await student_cache.purge(key=(region, registration, first_name))
+    else:
+        deleted = await student_cache.purge(negative_only=(mode == "notfound"))
+    await update.message.reply_text(f"✅ Purged {deleted} cached entries from disk.")
+
+def database_bytes(path: str) -> int:
+    return sum(os.path.getsize(name) for name in (path, path + "-wal") if os.path.exists(name))
+
+def archive_path(table: str, day: str) -> str:
+    return os.path.join(ARCHIVE_DIR, table, f"{day}.jsonl.gz")
+
+def retention_condition(table: str) -> str:
+    extra = RETENTION_FILTERS.get(table)
+    return "timestamp >= ? AND timestamp < ?" + (f" AND {extra}" if extra else "")
+
+def export_day(table: str, day: str, next_day: str) -> list:
+    # A WAL reader sees a snapshot and never blocks the writer
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cursor = conn.execute(
+            f"SELECT * FROM {table} WHERE {retention_condition(table)} ORDER BY id", (day, next_day)
+        )
+        columns = [column[0] for column in cursor.description]
+        exported = []
+        # Appending adds another gzip member, which gzip readers see as one stream. The file is
+        # synced before any row is deleted, so an interrupted run can duplicate rows but never lose them.
+        with open(archive_path(table, day), "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="ab") as archive:
+                for row in cursor:
+                    archive.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False).encode("utf-8") + b"\n")
+                    exported.append(row[0])
+            raw.flush()
+            os.fsync(raw.fileno())
+        return exported
+    finally:
+        conn.close()
+
+async def archive_day(table: str, day: str) -> int:
+    next_day = (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    exported = await asyncio.to_thread(export_day, table, day, next_day)
+    # Only the exported ids are deleted: a row that starts matching the filter after the
+    # snapshot (feedback replied to meanwhile) waits for the next run instead of being lost.
+    # Deletes go through the storage writer in short batches, queued with everything else
+    for start in range(0, len(exported), RETENTION_DELETE_BATCH):
+        ids = exported[start:start + RETENTION_DELETE_BATCH]
+        await storage.execute(f"DELETE FROM {table} WHERE id IN ({','.join('?' * len(ids))})", tuple(ids))
+    return len(exported)
+
+def maintain_database(conn: sqlite3.Connection) -> bool:
+    # Returns False while the database still needs /archive compact to reclaim space
+    incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    if incremental:
+        conn.execute("PRAGMA incremental_vacuum").fetchall()
+    conn.execute("PRAGMA analysis_limit = 1000")
+    conn.execute("ANALYZE")
+    conn.commit()
+    # Freed pages are only cut from the file once the WAL is checkpointed
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return incremental
+
+def compact_database(conn: sqlite3.Connection) -> None:
+    # Databases created before incremental mode need one full VACUUM to switch over
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+async def run_retention(path: str) -> dict:
+    started = time.monotonic()
+    report = {"archived": {}, "bytes_before": database_bytes(path)}
+    for table, days in RETENTION_DAYS.items():
+        if days <= 0:
+            continue
+        os.makedirs(os.path.join(ARCHIVE_DIR, table), exist_ok=True)
+        cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+        extra = RETENTION_FILTERS.get(table)
+        day_rows = await storage.fetchall(
+            f"SELECT DISTINCT substr(timestamp, 1, 10) FROM {table} WHERE timestamp < ?"
+            + (f" AND {extra}" if extra else "") + " ORDER BY 1",
+            (cutoff,)
+        )
+        report["archived"][table] = 0
+        for (day,) in day_rows:
+            report["archived"][table] += await archive_day(table, day)
+    report["incremental"] = await storage.run(maintain_database)
+    report["bytes_after"] = database_bytes(path)
+    report["seconds"] = time.monotonic() - started
+    return report
+
+def format_retention_report(report: dict) -> str:
+    archived = ", ".join(f"{table} {rows}" for table, rows in report["archived"].items()) or "nothing"
+    reclaimed = report["bytes_before"] - report["bytes_after"]
+    return (
+        f"🗃 <b>Retention</b>\n\n"
+        f"📦 Archived rows: {archived}\n"
+        f"💾 Database: {report['bytes_before'] / 1024 ** 2:.1f} MB → {report['bytes_after'] / 1024 ** 2:.1f} MB "
+        f"({reclaimed / 1024 ** 2:.1f} MB reclaimed)\n"
+        f"⏱ Took {report['seconds']:.1f}s"
+        + ("" if report["incremental"] else "\n⚠️ Free pages are not reclaimed until an admin runs /archive compact")
+    )
+
+retention_lock = asyncio.Lock()
+last_retention_report = None
+
+async def perform_retention() -> dict:
+    global last_retention_report
+    async with retention_lock:
+        report = await run_retention(DB_PATH)
+    last_retention_report = report
+    logger.info(f"Retention: archived {report['archived']}, database "
+                f"{report['bytes_before']} -> {report['bytes_after']} bytes in {report['seconds']:.1f}s")
+    return report
+
+async def retention_job(context: CallbackContext) -> None:
+    try:
+        report = await perform_retention()
+    except Exception as e:
+        logger.error(f"Retention run failed: {e}")
+        await notify_admins(context, f"⚠️ Retention run failed: {escape(str(e))}")
+        return
+    if any(report["archived"].values()) or report["bytes_after"] < report["bytes_before"]:
+        await notify_admins(context, format_retention_report(report))
+
+def read_archive(table: str, start: str, end: str, user_id: int = None) -> list:
+    directory = os.path.join(ARCHIVE_DIR, table)
+    if not os.path.isdir(directory):
+        return []
+    rows, seen = [], set()
+    for name in sorted(os.listdir(directory)):
+        day = name.split(".", 1)[0]
+        if not name.endswith(".jsonl.gz") or not start <= day <= end:
+            continue
+        with gzip.open(os.path.join(directory, name), "rt", encoding="utf-8") as archive:
+            for line in archive:
+                row = json_loads(line)
+                # Rows duplicated by an interrupted run are listed once
+                if row["id"] in seen or (user_id is not None and row.get("user_id") != user_id):
+                    continue
+                seen.add(row["id"])
+                rows.append(row)
+    return rows
+
+def archive_summary() -> list:
+    lines = []
+    for table in RETENTION_DAYS:
+        directory = os.path.join(ARCHIVE_DIR, table)
+        days = sorted(name.split(".", 1)[0] for name in os.listdir(directory)) if os.path.isdir(directory) else []
+        if not days:
+            lines.append(f"• {table}: no archives")
+            continue
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        lines.append(f"• {table}: {len(days)} days, {days[0]} → {days[-1]}, {size / 1024:.1f} KB")
+    return lines
+
+ARCHIVE_TABLES = {"usage": "usage_logs", "usage_logs": "usage_logs", "feedback": "feedback"}
+ARCHIVE_USAGE = (
+    "ℹ️ Usage: /archive | /archive run | /archive compact | "
+    "/archive <usage|feedback> <from YYYY-MM-DD> [to YYYY-MM-DD] [user_id]"
+)
+
+async def archive(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+    args = context.args
+    if not args:
+        windows = ", ".join(
+            f"{table} {days or '∞'}d" + (f" ({RETENTION_FILTERS[table]})" if table in RETENTION_FILTERS else "")
+            for table, days in RETENTION_DAYS.items()
+        )
+        message = "🗃 <b>Archives</b>\n\n" + "\n".join(await asyncio.to_thread(archive_summary)) + \
+            f"\n\n🕒 Retention: {windows}, daily at {RETENTION_TIME} UTC"
+        if last_retention_report:
+            message += "\n\n" + format_retention_report(last_retention_report)
+        await update.message.reply_text(message, parse_mode='HTML')
+        return
+    if args[0] == "run":
+        if retention_lock.locked():
+            await update.message.reply_text("⏳ A retention run is already in progress.")
+            return
+        progress = await update.message.reply_text("⏳ Running retention...")
+        try:
+            report = await perform_retention()
+        except Exception as e:
+            logger.error(f"Retention run failed: {e}")
+            await progress.edit_text(f"⚠️ Retention run failed: {e}")
+            return
+        await progress.edit_text(format_retention_report(report), parse_mode='HTML')
+        return
+    if args[0] == "compact":
+        if retention_lock.locked():
+            await update.message.reply_text("⏳ A retention run is already in progress.")
+            return
+        progress = await update.message.reply_text(
+            "⏳ Compacting the database. Writes are held until the full VACUUM finishes..."
+        )
+        try:
+            async with retention_lock:
+                before = database_bytes(DB_PATH)
+                started = time.monotonic()
+                await storage.run(compact_database)
+        except Exception as e:
+            logger.error(f"Database compaction failed: {e}")
+            await progress.edit_text(f"⚠️ Compaction failed: {e}")
+            return
+        after = database_bytes(DB_PATH)
+        await progress.edit_text(
+            f"✅ Database compacted: {before / 1024 ** 2:.1f} MB → {after / 1024 ** 2:.1f} MB "
+            f"in {time.monotonic() - started:.1f}s. Incremental vacuum is now enabled."
+        )
+        return
+    table = ARCHIVE_TABLES.get(args[0])
+    try:
+        if table is None or not 2 <= len(args) <= 4:
+            raise ValueError
+        start = datetime.strptime(args[1], "%Y-%m-%d").strftime("%Y-%m-%d")
+        end = datetime.strptime(args[2], "%Y-%m-%d").strftime("%Y-%m-%d") if len(args) > 2 else start
+        user_id = int(args[3]) if len(args) > 3 else None
+    except ValueError:
+        await update.message.reply_text(ARCHIVE_USAGE)
+        return
+    rows = await asyncio.to_thread(read_archive, table, start, end, user_id)
+    period = start if start == end else f"{start} → {end}"
+    if not rows:
+        await update.message.reply_text(f"🗃 No archived {table} rows for {period}.")
+        return
+    key = "action" if table == "usage_logs" else "replied"
+    counts = {}
+    for row in rows:
+        counts[row.get(key)] = counts.get(row.get(key), 0) + 1
+    breakdown = "\n".join(
+        f"• {key} {escape(str(value))}: {count}"
+        for value, count in sorted(counts.items(), key=lambda item: -item[1])[:10]
+    )
+    output = StringIO()
+    writer = csv.DictWriter(output, fieldnames=list(rows[0]), restval="")
+    writer.writeheader()
+    writer.writerows(rows)
+    await update.message.reply_document(
+        document=BytesIO(output.getvalue().encode("utf-8-sig")),
+        filename=f"{table}_{start}_{end}.csv",
+        caption=f"🗃 <b>{table}</b> {period}: {len(rows)} rows\n{breakdown}",
+        parse_mode='HTML'
+    )
+
 async def error_handler(update: Update, context: CallbackContext) -> None:
     logger.error(f"Error: {context.error}")
     error_msg = await update.message.reply_text("❌ An error occurred. Please try again later.")
-    context.user_data.setdefault('message_ids', []).append(error_msg.message_id)
+    track_message(context.user_data, error_msg.message_id)
 
-def main() -> None:
-    init_db()
-    global subscribed_users
-    subscribed_users = load_subscribers()
+def _ratio(hits: float, total: float) -> float:
+    return hits / total if total else 0.0
+
+def cache_hit_ratios() -> dict:
+    photos = photo_store.stats
+    photo_hits = photos["file_id_hits"] + photos["store_hits"]
+    membership = membership_cache.stats
+    return {
+        (("cache", "result"),): _ratio(sum(student_cache.hits.values()), sum(student_cache.hits.values()) + student_cache.misses),
+        (("cache", "photo"),): _ratio(photo_hits, photo_hits + photos["downloads"]),
+        (("cache", "membership"),): _ratio(membership["hits"], membership["hits"] + membership["misses"]),
+    }
+
+metrics.gauge("bot_http_requests_in_flight", "Upstream HTTP requests currently open", lambda: http_requests_in_flight)
+metrics.gauge("bot_lookups_in_flight", "Distinct result lookups waiting on upstream", lambda: len(inflight_lookups))
+metrics.gauge("bot_updates", "Telegram updates by state", lambda: {
+    (("state", "running"),): update_processor.running,
+    (("state", "queued"),): update_processor.queued,
+})
+metrics.gauge("bot_storage_pending_writes", "Writes queued for the SQLite writer", lambda: storage.pending())
+metrics.gauge("bot_cache_hit_ratio", "Hit ratio per cache", cache_hit_ratios)
+metrics.gauge("bot_upstream_concurrency_limit", "Adaptive concurrency limit per region", lambda: {
+    (("region", region),): limiter.limit for region, limiter in upstream_limiters.items()
+})
+metrics.gauge("bot_route_success_ratio", "Recent success ratio per region and fetch route", lambda: {
+    (("region", region), ("route", route)): stats.success_rate()
+    for (region, route), stats in route_selector.stats.items()
+})
+metrics.gauge("bot_startup_seconds", "Time spent in each cold-start stage", lambda: {
+    (("stage", stage),): seconds for stage, seconds in startup.stages.items()
+})
+metrics.gauge("bot_upstream_in_flight", "Upstream requests in flight per region", lambda: {
+    (("region", region),): limiter.in_flight for region, limiter in upstream_limiters.items()
+})
+
+async def perf(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+    lines = []
+    for name in ("bot_lookup_seconds", "bot_stage_seconds"):
+        for labels, (p50, p95, p99) in sorted(metrics.percentiles(name).items()):
+            label = ",".join(str(value) for _, value in labels) or name
+            lines.append(f"{label}: {p50 * 1000:.0f} / {p95 * 1000:.0f} / {p99 * 1000:.0f}")
+    if not lines:
+        await update.message.reply_text("ℹ️ No measurements yet.")
+        return
+    await update.message.reply_text(
+        "⏱ <b>Latency ms (p50 / p95 / p99)</b>\n<pre>" + escape("\n".join(lines)) + "</pre>",
+        parse_mode='HTML'
+    )
+
+# setWebhook only when Telegram's registration differs from ours, so a restart neither
+# resets the webhook nor, unless DROP_PENDING_UPDATES is set, discards the updates queued for it
+async def ensure_webhook(bot, webhook_url: str) -> None:
+    info = await bot.get_webhook_info()
+    wanted = (webhook_url, sorted(Update.ALL_TYPES), WEBHOOK_MAX_CONNECTIONS)
+    current = (info.url, sorted(info.allowed_updates or ()), info.max_connections)
+    if current == wanted and not DROP_PENDING_UPDATES:
+        logger.info(f"Webhook already registered, {info.pending_update_count} pending updates")
+        return
+    await bot.set_webhook(
+        url=webhook_url, allowed_updates=Update.ALL_TYPES, max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=DROP_PENDING_UPDATES,
+    )
+    logger.info(f"Webhook registered ({info.pending_update_count} pending updates"
+                f"{', dropped' if DROP_PENDING_UPDATES else ''})")
+
+# Webhook server: Telegram updates on /<token>, plus /metrics and /healthz
+def build_web_app(application) -> web.Application:
+    async def handle_update(request: web.Request) -> web.Response:
+        update = Update.de_json(await request.json(), application.bot)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        if METRICS_TOKEN and request.query.get("token") != METRICS_TOKEN:
+            return web.Response(status=403)
+        return web.Response(
+            body=metrics.render().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def handle_health(request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    web_app = web.Application()
+    web_app.router.add_post(f"/{TOKEN}", handle_update)
+    web_app.router.add_get("/metrics", handle_metrics)
+    web_app.router.add_get("/healthz", handle_health)
+    return web_app
+
+async def run_webhook_server(application, webhook_url: str, port: int, host: str = "0.0.0.0") -> None:
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    # Listen first: updates that arrive while the database warms up wait in update_queue
+    # and are processed once the application starts, instead of timing out at Telegram
+    runner = web.AppRunner(build_web_app(application))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    startup.mark("listen")
+    logger.info(f"Webhook server listening on port {port}")
+    try:
+        await asyncio.to_thread(init_db)
+        startup.mark("db")
+        await application.initialize()
+        startup.mark("initialize")
+        if application.post_init:
+            await application.post_init(application)
+        startup.mark("post_init")
+        await application.start()
+        startup.mark("start")
+        if webhook_url:
+            await ensure_webhook(application.bot, webhook_url)
+            startup.mark("webhook")
+        logger.info(f"Startup took {startup.summary()}")
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# Dispatcher for scaled mode: owns the public webhook and forwards each update to the worker
+# that owns its user, so conversation state and per-chat ordering stay within one process.
+def update_routing_key(payload: dict) -> int:
+    for value in payload.values():
+        if not isinstance(value, dict):
+            continue
+        # chat_member updates belong with the member they describe, not the admin who changed it
+        user = (value.get("new_chat_member") or {}).get("user") or value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+        if value.get("chat"):
+            return value["chat"]["id"]
+    return 0
+
+def worker_for(key: int) -> int:
+    return zlib.crc32(str(key).encode()) % WEBHOOK_WORKERS
+
+def merge_worker_metrics(texts: dict) -> str:
+    # Regroup samples by family so each metric keeps a single HELP/TYPE header
+    families = {}
+    for worker, text in texts.items():
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# "):
+                family = families.setdefault(line.split(" ", 3)[2], ([], []))
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line and family is not None:
+                name, _, value = line.partition(" ")
+                if "{" in name:
+                    name = name.replace("{", f'{{worker="{worker}",', 1)
+                else:
+                    name = f'{name}{{worker="{worker}"}}'
+                family[1].append(f"{name} {value}")
+    return "".join("\n".join(headers + samples) + "\n" for headers, samples in families.values())
+
+class WorkerPool:
+    def __init__(self, size: int, port_base: int):
+        self.size = size
+        self.port_base = port_base
+        self.processes = {}
+        self.restarts = 0
+        self.stopping = False
+        self.started_at = {}
+        self.crashes = {}
+        self.restart_at = {}
+
+    def spawn(self, index: int) -> None:
+        env = dict(os.environ, WORKER_INDEX=str(index), PORT=str(self.port_base + index))
+        self.processes[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        self.started_at[index] = time.monotonic()
+        logger.info(f"Started worker {index} (pid {self.processes[index].pid}) on port {self.port_base + index}")
 
-    application = ApplicationBuilder().token(TOKEN).build()
+    def start(self) -> None:
+        for index in range(self.size):
+            self.spawn(index)
+
+    async def supervise(self) -> None:
+        while not self.stopping:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for index, process in list(self.processes.items()):
+                if process.poll() is None or self.stopping:
+                    continue
+                if index not in self.restart_at:
+                    # Exponential backoff while a worker keeps dying soon after it starts
+                    if now - self.started_at[index] < WORKER_STABLE_SECONDS:
+                        self.crashes[index] = self.crashes.get(index, 0) + 1
+                    else:
+                        self.crashes[index] = 0
+                    delay = min(WORKER_RESTART_MAX_DELAY, 2 ** self.crashes[index] - 1)
+                    self.restart_at[index] = now + delay
+                    logger.error(f"Worker {index} exited with {process.returncode}, restarting in {delay:.0f}s")
+                if now >= self.restart_at[index]:
+                    del self.restart_at[index]
+                    self.restarts += 1
+                    self.spawn(index)
+
+    def alive(self) -> int:
+        return sum(process.poll() is None for process in self.processes.values())
+
+    async def stop(self, timeout: float = 30) -> None:
+        self.stopping = True
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for index, process in self.processes.items():
+            try:
+                await asyncio.to_thread(process.wait, max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning(f"Worker {index} did not stop in time, killing it")
+                process.kill()
+
+async def run_dispatcher(webhook_url: str, port: int) -> None:
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    pool = WorkerPool(WEBHOOK_WORKERS, WORKER_PORT_BASE)
+    pool.start()
+    supervisor = asyncio.ensure_future(pool.supervise())
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT),
+        timeout=aiohttp.ClientTimeout(total=WORKER_FORWARD_TIMEOUT),
+    )
+    # The module-level gauges describe a worker's state, so the dispatcher keeps its own registry
+    dispatch_metrics = Metrics(LATENCY_BUCKETS)
+    dispatch_metrics.gauge("bot_workers_alive", "Worker processes currently running", pool.alive)
+    dispatch_metrics.gauge("bot_worker_restarts", "Worker processes restarted after exiting", lambda: pool.restarts)
+
+    async def forward(worker: int, body: bytes) -> int:
+        # A worker that is still starting refuses connections; hold the update until it
+        # listens rather than bouncing it back to Telegram's slower redelivery schedule
+        deadline = time.monotonic() + WORKER_FORWARD_TIMEOUT
+        while True:
+            try:
+                async with session.post(
+                    f"http://127.0.0.1:{WORKER_PORT_BASE + worker}/{TOKEN}",
+                    data=body, headers={"Content-Type": "application/json"},
+                ) as response:
+                    return response.status
+            except aiohttp.ClientConnectorError:
+                if time.monotonic() + 0.1 >= deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+    async def handle_update(request: web.Request) -> web.Response:
+        body = await request.read()
+        worker = worker_for(update_routing_key(json_loads(body)))
+        try:
+            status = await forward(worker, body)
+            dispatch_metrics.inc("bot_dispatched_updates_total", worker=worker)
+            return web.Response(status=status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # A non-2xx answer makes Telegram redeliver the update once the worker is back
+            dispatch_metrics.inc("bot_dispatch_errors_total", worker=worker)
+            logger.warning(f"Could not forward update to worker {worker}: {e}")
+            return web.Response(status=503)
+
+    async def fetch_worker_metrics(worker: int) -> str:
+        try:
+            async with session.get(
+                f"http://127.0.0.1:{WORKER_PORT_BASE + worker}/metrics", params={"token": METRICS_TOKEN}
+            ) as response:
+                return await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return ""
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        if METRICS_TOKEN and request.query.get("token") != METRICS_TOKEN:
+            return web.Response(status=403)
+        texts = await asyncio.gather(*(fetch_worker_metrics(worker) for worker in range(WEBHOOK_WORKERS)))
+        body = dispatch_metrics.render() + merge_worker_metrics(dict(enumerate(texts)))
+        return web.Response(
+            body=body.encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def handle_health(request: web.Request) -> web.Response:
+        alive = pool.alive()
+        return web.Response(text=f"{alive}/{WEBHOOK_WORKERS} workers", status=200 if alive else 503)
+
+    web_app = web.Application()
+    web_app.router.add_post(f"/{TOKEN}", handle_update)
+    web_app.router.add_get("/metrics", handle_metrics)
+    web_app.router.add_get("/healthz", handle_health)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    startup.mark("listen")
+    logger.info(f"Dispatcher listening on port {port} for {WEBHOOK_WORKERS} workers")
+
+    bot = Bot(TOKEN, base_url=f"{TELEGRAM_API_URL}/bot") if TELEGRAM_API_URL else Bot(TOKEN)
+    async with bot:
+        await ensure_webhook(bot, webhook_url)
+    startup.mark("webhook")
+    logger.info(f"Dispatcher startup took {startup.summary()}")
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        supervisor.cancel()
+        await pool.stop()
+        await session.close()
+
+async def warm_subscribers(context: CallbackContext = None):
+    subscribed_users.update(await load_subscribers())
+    logger.info(f"Loaded {len(subscribed_users)} subscribers")
+
+async def post_init(application) -> None:
+    get_http_session()
+    # Nothing on the request path reads the subscriber set, so it fills in after startup
+    if application.job_queue:
+        application.job_queue.run_once(warm_subscribers, 0)
+    else:
+        await warm_subscribers()
+    if application.job_queue:
+        application.job_queue.run_repeating(evict_idle_user_data, interval=PERSISTENCE_EVICT_INTERVAL)
+    if HTTP_POOL_REPORT_INTERVAL > 0 and application.job_queue:
+        application.job_queue.run_repeating(report_http_pool, interval=HTTP_POOL_REPORT_INTERVAL)
+    await load_route_pins()
+    if application.job_queue:
+        application.job_queue.run_repeating(refresh_route_pins, interval=ROUTE_PIN_REFRESH_INTERVAL)
+        application.job_queue.run_repeating(resume_broadcasts, interval=BROADCAST_LEASE_SECONDS, first=1)
+    # Process-wide singletons run once, on the first worker in scaled mode
+    if WORKER_INDEX not in (None, "0"):
+        return
+    if application.job_queue:
+        application.job_queue.run_daily(retention_job, time=datetime.strptime(RETENTION_TIME, "%H:%M").time())
+    if RELEASE_CANARIES and application.job_queue:
+        application.job_queue.run_repeating(watch_result_release, interval=RELEASE_WATCH_INTERVAL, first=10)
+
+async def post_shutdown(application) -> None:
+    await close_http_session()
+    await asyncio.to_thread(storage.close)
+    shutdown_pdf_executor()
+    shutdown_photo_executor()
+    student_cache.close()
+    photo_store.close()
+
+def build_application():
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(update_processor)
+        .persistence(persistence)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler('start', start),
             CommandHandler('feedback', feedback_start),
+            CommandHandler('bulk', bulk_start),
             CallbackQueryHandler(feedback_start, pattern="^(feedback|feedback_amharic)$"),
             CallbackQueryHandler(check_result_start, pattern="^(check_result|check_result_amharic)$"),
         ],
@@ -654,33 +4357,65 @@ def main() -> None:
             REGISTRATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_registration)],
             FIRST_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_first_name)],
             FEEDBACK: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_feedback)],
+            BULK_UPLOAD: [
+                MessageHandler(filters.Document.FileExtension("csv"), receive_bulk_csv),
+                MessageHandler(~filters.COMMAND, bulk_invalid_upload),
+            ],
         },
         fallbacks=[],
-        allow_reentry=True
+        allow_reentry=True,
+        name="main_conversation",
+        persistent=True,
     )
 
     application.add_handler(conv_handler)
+    application.add_handler(ChatMemberHandler(track_channel_membership, ChatMemberHandler.CHAT_MEMBER))
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(CommandHandler("broadcast_status", broadcast_status))
     application.add_handler(CommandHandler("reply", reply_to_feedback))
     application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("upstream", upstream))
+    application.add_handler(CommandHandler("route", routes))
+    application.add_handler(CommandHandler("perf", perf))
+    application.add_handler(CommandHandler("cache", cache_info))
+    application.add_handler(CommandHandler("cache_purge", cache_purge))
+    application.add_handler(CommandHandler("archive", archive))
     application.add_error_handler(error_handler)
+    return application
 
+def main() -> None:
     webhook_url = os.getenv("WEBHOOK_URL", f"https://twotebot.onrender.com/{TOKEN}")
     port = int(os.getenv("PORT", 5000))
 
+    startup.mark("imports")
+    if WORKER_INDEX is not None:
+        application = build_application()
+        startup.mark("build")
+        logger.info(f"Starting webhook worker {WORKER_INDEX}...")
+        asyncio.get_event_loop().run_until_complete(
+            run_webhook_server(application, None, port, host="127.0.0.1")
+        )
+        return
+    if webhook_url and WEBHOOK_WORKERS > 1:
+        # Migrate once here so the workers don't race each other on ALTER TABLE
+        init_db()
+        storage.close()
+        startup.mark("db")
+        logger.info(f"Starting bot in scaled webhook mode with {WEBHOOK_WORKERS} workers...")
+        asyncio.get_event_loop().run_until_complete(run_dispatcher(webhook_url, port))
+        return
+
+    application = build_application()
+    startup.mark("build")
     if webhook_url:
         logger.info("Starting bot in webhook mode...")
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=port,
-            url_path=TOKEN,
-            webhook_url=webhook_url,
-            drop_pending_updates=True,
-        )
+        # Same loop PTB's run_webhook would use, so objects created at build time stay valid on 3.9
+        asyncio.get_event_loop().run_until_complete(run_webhook_server(application, webhook_url, port))
     else:
         logger.info("Starting bot in polling mode...")
-        application.run_polling()
+        init_db()
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()